@@ -1,18 +1,24 @@
 __author__ = 'Olav'
 
 import numpy as np
+import multiprocessing as mp
 import random
 import theano
 
 import augmenter.util as util
+from PIL import Image
 from dataset import Dataset
+from cache import TileCache
+from parallel import ParallelSampler
+from plan import create_records
 
 class Creator(object):
     '''
     Dynamically load and convert data to appropriate format for theano.
     '''
     def __init__(self, dataset_path, dim=(64, 16), rotation=False, preproccessing=True, only_mixed=False, std=1,
-                 mix_ratio=0.5, reduce_testing=1, reduce_training=1, reduce_validation=1):
+                 mix_ratio=0.5, reduce_testing=1, reduce_training=1, reduce_validation=1, batched=True,
+                 workers=1, seed=0, cache_size=0, compact=False, noise_cache=None):
         self.dim_data = dim[0]
         self.dim_label = dim[1]
         self.only_mixed_labels = only_mixed # Only use labels containing positive label (roads etc)
@@ -25,6 +31,13 @@ class Creator(object):
         self.reduce_training = reduce_training
         self.reduce_validation = reduce_validation
         self.dataset_path = dataset_path
+        self.batched = batched # Extract all patches of an opened image as whole-array operations
+        self.workers = workers if workers > 0 else mp.cpu_count() # Sampling processes used by dynamically_create
+        self.seed = seed
+        self.cache_size = cache_size # Memory budget in mb for decoded tiles, shared by all three sets.
+        self.compact = compact # Keep examples as uint8, rescaling and normalization is done by the data loader.
+        self.dtype = np.uint8 if compact else theano.config.floatX
+        self.noise_cache = noise_cache # Folder where noisy labels are kept between runs.
         # Load paths to all images found in dataset
 
 
@@ -33,32 +46,59 @@ class Creator(object):
 
     def load_dataset(self):
         test_path, train_path, valid_path = util.get_dataset(self.dataset_path)
-        self.test = Dataset("Test set", self.dataset_path, test_path, self.reduce_testing )
-        self.train = Dataset("Training set", self.dataset_path, train_path, self.reduce_training )
-        self.valid = Dataset("Validation set", self.dataset_path, valid_path, self.reduce_validation)
-
-
-    def dynamically_create(self, samples_per_image, enable_label_noise=False, label_noise=0.0, only_mixed=False):
+        self.cache = None
+        if self.cache_size > 0:
+            self.cache = TileCache(self.cache_size)
+        self.test = Dataset("Test set", self.dataset_path, test_path, self.reduce_testing, cache=self.cache,
+                            noise_path=self.noise_cache)
+        self.train = Dataset("Training set", self.dataset_path, train_path, self.reduce_training, cache=self.cache,
+                             noise_path=self.noise_cache)
+        self.valid = Dataset("Validation set", self.dataset_path, valid_path, self.reduce_validation, cache=self.cache,
+                             noise_path=self.noise_cache)
+
+
+    def dynamically_create(self, samples_per_image, enable_label_noise=False, label_noise=0.0, only_mixed=False,
+                           evaluation=True):
         '''
-        Samples patch datasets at runtime. Creates a validation, test, and training set.
+        Samples patch datasets at runtime. Creates a validation, test, and training set. Without evaluation, only the
+        training set is sampled, and None is returned for the others.
         '''
         self.load_dataset()
 
         print('{}# test img, {}# train img, {}# valid img'.format(
             self.test.nr_img, self.train.nr_img, self.valid.nr_img))
 
-        test = self.sample_data(self.test, samples_per_image)
         #TODO: Rotation should be renamed to data augmentation, or a new parameter. Only if rotation currently.
         #TODO: only_mixed_labels not in init!
-        train = self.sample_data(self.train,
-                                 samples_per_image,
-                                 mixed_labels=self.only_mixed_labels,
-                                 rotation=self.rotation,
-                                 label_noise=label_noise,
-                                 label_noise_enable=enable_label_noise
-                                 )
-        valid = self.sample_data(self.valid, samples_per_image)
-
+        train_args = {
+            'mixed_labels': self.only_mixed_labels,
+            'rotation': self.rotation,
+            'label_noise': label_noise,
+            'label_noise_enable': enable_label_noise
+        }
+
+        if self.workers > 1:
+            #All three sets are sampled concurrently by the same pool of workers.
+            sampler = ParallelSampler(self, self.workers, seed=self.seed)
+            if not evaluation:
+                train, = sampler.sample([(self.train, samples_per_image, train_args)])
+                return train, None, None
+            test, train, valid = sampler.sample([
+                (self.test, samples_per_image, {}),
+                (self.train, samples_per_image, train_args),
+                (self.valid, samples_per_image, {})
+            ])
+            return train, valid, test
+
+        test = valid = None
+        if evaluation:
+            test = self.sample_data(self.test, samples_per_image)
+        train = self.sample_data(self.train, samples_per_image, **train_args)
+        if evaluation:
+            valid = self.sample_data(self.valid, samples_per_image)
+
+        if self.cache:
+            self.cache.print_report()
         return train, valid, test
 
 
@@ -70,23 +110,41 @@ class Creator(object):
         In addition, the sampling considers the balance between road and non-road pixels, if mixed_labels are set to
         True, label noise is added to label images if enabled, and curriculum enables sampling for a staged dataset.
         '''
-        nr_class = 0
-        nr_total = 1
-
-        dropped_images = 0
-        curriculum_dropped = 0
-        curriculum_road_dropped = 0
-        nr_opened_images = 0
+        #The whole set is sampled as a single batch, so there is no extra copy.
+        nr_examples = self.get_nr_examples(dataset, samples_per_images)
+        data, label = self._create_batch(0)
+        for data, label, stats in self.sample_batches(dataset, samples_per_images, nr_examples,
+                                                      mixed_labels=mixed_labels,
+                                                      rotation=rotation,
+                                                      curriculum=curriculum,
+                                                      curriculum_threshold=curriculum_threshold,
+                                                      label_noise_enable=label_noise_enable,
+                                                      label_noise=label_noise,
+                                                      best_trade_off=best_trade_off):
+            pass
+        #print('---- Creating permutation')
+        #perm = np.random.permutation(len(data))
+        #data = data[perm]
+        #label = label[perm]
+        #print('Examples shuffled')
+        return data, label
 
 
-        dim_data = self.dim_data
-        dim_label = self.dim_label
+    def sample_batches(self, dataset, samples_per_images, batch_size, mixed_labels=False, rotation=False,
+                       curriculum=None, curriculum_threshold=1.0, label_noise_enable=False, label_noise=0.0,
+                       best_trade_off = 0.5, plan=False, keep_records=False):
+        '''
+        Streaming version of sample_data. Examples are yielded in batches of batch_size as soon as enough are sampled,
+        so consumers can process the set while it is sampled, and only a single batch is kept in memory. The last
+        batch can be smaller. In total get_nr_examples examples are yielded. With plan, sampling plan records are
+        yielded instead of data. With keep_records, the records of the examples are yielded as a fourth element.
+        :return: Generator of data, label and the running sampling stats
+        '''
+        stats = Creator.create_stats()
+        nr_opened_images = 0
 
         max_image_samples = int(samples_per_images * dataset.reduce)
-
-        max_arr_size = dataset.nr_img * max_image_samples
-        data = np.empty((max_arr_size, dim_data*dim_data*3), dtype=theano.config.floatX)
-        label = np.empty((max_arr_size, self.dim_label*self.dim_label), dtype=theano.config.floatX)
+        example_counter = self.get_nr_examples(dataset, samples_per_images)
 
         print('')
         if label_noise_enable:
@@ -101,7 +159,10 @@ class Creator(object):
 
         # Images are opened, rotated and max_image_Samples examples are extracted per image.
         image_queue = list(range(dataset.nr_img))
-        example_counter = max_arr_size
+        nr_yielded = 0
+        if example_counter > 0:
+            data, label = self._create_batch(min(batch_size, example_counter), plan)
+            records = create_records(data.shape[0]) if keep_records else None
         idx = 0
 
         while example_counter > 0:
@@ -114,110 +175,41 @@ class Creator(object):
             image_queue.append(image_idx)
             nr_opened_images += 1
 
-            im, la = dataset.open_image(image_idx)
-
-            width, height = im.size
-            width = width - dim_data
-            height = height - dim_data
-            #print("sampling", width, height)
-
-            if label_noise_enable:
-                la, prob = util.add_artificial_road_noise(la, label_noise)
-
-            rot = 0
-            if rotation:
-                rot = random.uniform(0.0, 360.0)
-            image_img = np.asarray(im.rotate(rot))
-            label_img = np.asarray(la.rotate(rot))
-
-            # Some selections will definitely fail, but because of the rotating queue,
-            # eventually we have enough examples.
-            # This will also mean images that have a lot of no-content will have less samples.
-            for i in range(max_image_samples):
-
-                x = random.randint(0, width)
-                y = random.randint( 0, height)
-
-                data_temp =     image_img[y : y+dim_data, x : x+dim_data]
-                label_temp =    label_img[y : y+dim_data, x : x+dim_data]
-
-                if self.img_have_alpha:
-                    alpha_min = np.amin(data_temp[0: dim_data, 0: dim_data, 3])
-                    if alpha_min <= 0:
-                        #If a single pixel is transparent, the patch is outside the border.
-                        dropped_images += 1
-                        continue
-                    #Convert to RGB
-
-                    data_temp = data_temp[0: dim_data, 0: dim_data, 0:3]
-
-                #TODO: new config parameter
-                if(rotation):
-                    # Increase diversity of samples by flipping horizontal and vertical.
-                    # Smart for aerial imagery, because you can flip in two directions.
-                    # For natural imagery (sky etc) horizontal flips is bad. Characters all flips are probably bad.
-                    choice = random.randint(0, 2)
-                    if choice == 0:
-                        data_temp = np.flipud(data_temp)
-                        label_temp = np.flipud(label_temp)
-                    elif choice == 1:
-                        data_temp = np.fliplr(data_temp)
-                        label_temp = np.fliplr(label_temp)
-                    #Otherwise no further agumentation (choice == 2)
-
-                data_sample =   util.from_rgb_to_arr(data_temp)
-                label_sample =  util.create_image_label(label_temp, dim_data, dim_label)
-
-                if self.preprocessing:
-                    data_sample = util.normalize(data_sample, self.std)
-
-                 # Count percentage of labels contain roads.
-                contains_class = not label_sample.max() == 0
-                if(mixed_labels and nr_class/float(nr_total) < self.mix_ratio and not contains_class):
-                    #Will sample same amount from road and non-road class
-                    continue
-
-                if curriculum and curriculum_threshold < 1.0:
-                    #This slows down sampling considerably, so only running once, and storing dataset is a given.
-                    #If threshold is 1, only random sampling, with normal dataset distribution.
-                    output = curriculum(np.array([data_sample]))
-                    output = util.create_threshold_image(output, best_trade_off)
-                    diff = np.sum(np.abs(output[0] - label_sample))/(dim_label*dim_label)
-
-                    #Patches with roads, are automatically harder, and have a a bit more lenient threshold.
-                    #if diff > curriculum_threshold+ (0.1*int(contains_class)):
-                    #if diff < int(contains_class) * curriculum_threshold:
-                    if diff > curriculum_threshold:
-                        curriculum_road_dropped += int(contains_class)
-                        curriculum_dropped += 1
-                        continue
-
-
-
-                nr_total += 1
-                nr_class += int(contains_class)
-
-                if not self.img_have_alpha:
-                    #RGB only. Only filters out entirely white or black areas
-                    max_element = data_sample.max()
-                    min_element = data_sample.min()
-
-                    # will filter out a whole lot of images.
-                    if max_element != min_element:
-                        data[idx] = data_sample
-                        label[idx] = label_sample
-                        idx += 1
-                        example_counter -= 1
+            sampled = self.sample_image(dataset, image_idx, max_image_samples, example_counter, stats,
+                                        mixed_labels=mixed_labels,
+                                        rotation=rotation,
+                                        curriculum=curriculum,
+                                        curriculum_threshold=curriculum_threshold,
+                                        label_noise_enable=label_noise_enable,
+                                        label_noise=label_noise,
+                                        best_trade_off=best_trade_off,
+                                        plan=plan,
+                                        keep_records=keep_records)
+            data_batch, label_batch = sampled[:2]
+            nr_accepted = data_batch.shape[0]
+            example_counter -= nr_accepted
+
+            #Accepted examples of an image can be split between two batches.
+            start = 0
+            while start < nr_accepted:
+                n = min(data.shape[0] - idx, nr_accepted - start)
+                data[idx: idx + n] = data_batch[start: start + n]
+                label[idx: idx + n] = label_batch[start: start + n]
+                if keep_records:
+                    records[idx: idx + n] = sampled[2][start: start + n]
+                idx += n
+                start += n
+                if idx == data.shape[0]:
+                    nr_yielded += idx
+                    if keep_records:
+                        yield data, label, stats, records
                     else:
-                        dropped_images += 1
-                else:
-                    #RGBA. Filters out areas that is determined to be non-content. (Bigger white areas set to transparent)
-                    data[idx] = data_sample
-                    label[idx] = label_sample
-                    idx += 1
-                    example_counter -= 1
-                if example_counter <= 0:
-                    break
+                        yield data, label, stats
+                    remaining = example_counter + nr_accepted - start
+                    if remaining > 0:
+                        data, label = self._create_batch(min(batch_size, remaining), plan)
+                        records = create_records(data.shape[0]) if keep_records else None
+                    idx = 0
 
             # Reduce samples per image after first pass through
             if not mixed_labels and nr_opened_images % dataset.nr_img == 0 :
@@ -228,9 +220,389 @@ class Creator(object):
                 print('---- Input image: {}/{}'.format(nr_opened_images, dataset.nr_img))
                 print('---- Patches remaining: {}'.format(example_counter))
 
-        print("---- Extracted {} images from {}".format(data.shape[0], dataset.name))
+        Creator.print_stats(dataset, nr_yielded, stats, curriculum)
+
+
+    def get_nr_examples(self, dataset, samples_per_images):
+        '''
+        Number of examples sampled from dataset by sample_data and sample_batches.
+        '''
+        return dataset.nr_img * int(samples_per_images * dataset.reduce)
+
+
+    def sample_image(self, dataset, image_idx, nr_samples, limit, stats, mixed_labels=False, rotation=False,
+                     curriculum=None, curriculum_threshold=1.0, label_noise_enable=False, label_noise=0.0,
+                     best_trade_off=0.5, plan=False, keep_records=False):
+        '''
+        Opens a single image of dataset and extracts nr_samples candidate patches from it. At most limit of the
+        candidates are accepted. The road/non-road balance is decided by the running counts in stats, which is updated
+        with the outcome of the sampling. With plan, the sampling plan records of the accepted examples are returned
+        instead of the data. With keep_records, they are returned as well, after the data and labels.
+        :return: Accepted data and label examples
+        '''
+        dim_label = self.dim_label
+        image_img, label_img = dataset.open_arrays(image_idx)
+
+        if label_noise_enable:
+            #The same noisy label is used on every visit of the image.
+            label_img = dataset.open_noisy_label(image_idx, label_noise, self.seed)
+
+        #With an alpha channel, batched extraction rotates each patch on its own, instead of the whole tile.
+        indexed = self.batched and self.img_have_alpha
+        if (plan or keep_records) and not indexed:
+            raise Exception('Sampling plans need batched sampling of images with an alpha channel')
+        if rotation and not indexed:
+            rot = random.uniform(0.0, 360.0)
+            image_img = np.asarray(Image.fromarray(image_img).rotate(rot))
+            label_img = np.asarray(Image.fromarray(label_img).rotate(rot))
+
+        # Some selections will definitely fail, but because of the rotating queue,
+        # eventually we have enough examples.
+        # This will also mean images that have a lot of no-content will have less samples.
+        #With an alpha channel, positions are drawn from indices, and mixed labels are drawn directly in the ratio.
+        balanced = False
+        if indexed:
+            balanced = mixed_labels
+            window = self.get_rotation_window() if rotation else self.dim_data
+            noise = (label_noise, self.seed) if label_noise_enable else None
+            positions = self._draw_positions(dataset, image_idx, nr_samples, mixed_labels, window, noise, stats)
+            data_batch, label_batch, dropped, records = self._extract_batch(image_img, label_img, nr_samples,
+                                                                            rotation, positions=positions,
+                                                                            rotate_patches=rotation)
+            records['tile'] = image_idx
+            records['noise_seed'] = self.seed if label_noise_enable else -1
+        elif self.batched:
+            data_batch, label_batch, dropped, records = self._extract_batch(image_img, label_img, nr_samples, rotation)
+        else:
+            data_batch, label_batch, dropped = self._extract(image_img, label_img, nr_samples, rotation)
+        stats['dropped'] += dropped
+
+        # Count percentage of labels contain roads.
+        contains_class = label_batch.max(axis=1) > 0
+
+        use_curriculum = curriculum and curriculum_threshold < 1.0
+        if use_curriculum:
+            #This slows down sampling considerably, so only running once, and storing dataset is a given.
+            #If threshold is 1, only random sampling, with normal dataset distribution.
+            #All candidates of the image are scored by the teacher in one call, which runs them in large batches.
+            if self.compact:
+                #The teacher needs the same input as during its own training.
+                output = curriculum(util.decode_data(data_batch, self.std, self.preprocessing, theano.config.floatX))
+                labels = util.decode_labels(label_batch, theano.config.floatX)
+            else:
+                output = curriculum(data_batch)
+                labels = label_batch
+            output = util.create_threshold_image(output, best_trade_off)
+            diff = np.sum(np.abs(output - labels), axis=1)/(dim_label*dim_label)
+
+            #Patches with roads, are automatically harder, and have a a bit more lenient threshold.
+            #if diff > curriculum_threshold+ (0.1*int(contains_class)):
+            #if diff < int(contains_class) * curriculum_threshold:
+            too_difficult = diff > curriculum_threshold
+
+        accepted = []
+        for i in range(data_batch.shape[0]):
+            if(mixed_labels and not balanced and stats['class']/float(stats['total']) < self.mix_ratio
+               and not contains_class[i]):
+                #Will sample same amount from road and non-road class
+                continue
+
+            if use_curriculum and too_difficult[i]:
+                stats['curriculum_road_dropped'] += int(contains_class[i])
+                stats['curriculum_dropped'] += 1
+                continue
+
+            stats['total'] += 1
+            stats['class'] += int(contains_class[i])
+            accepted.append(i)
+            if len(accepted) >= limit:
+                break
+
+        if plan:
+            return records[accepted], label_batch[accepted]
+        if keep_records:
+            return data_batch[accepted], label_batch[accepted], records[accepted]
+        return data_batch[accepted], label_batch[accepted]
+
+
+    def extract_records(self, dataset, records, rotation, label_noise=0.0):
+        '''
+        Rebuilds the examples of sampling plan records from the tiles of dataset. The patches are extracted with the
+        recorded positions and augmentation, which gives the same examples as when the plan was sampled.
+        :param rotation: The records were sampled with rotation
+        :return: data and label examples, in the order of the records
+        '''
+        data, label = self._create_batch(len(records))
+        for group, tile, noise_seed in Creator._group_records(records):
+            group_records = records[group]
+            image_img, label_img = dataset.open_arrays(tile)
+            if noise_seed >= 0:
+                label_img = dataset.open_noisy_label(tile, label_noise, noise_seed)
+
+            positions = (group_records['y'], group_records['x'])
+            data_batch, label_batch, dropped, r = self._extract_batch(image_img, label_img, len(group), rotation,
+                                                                      positions=positions, rotate_patches=rotation,
+                                                                      angles=group_records['angle'],
+                                                                      choice=group_records['flip'])
+            if dropped > 0:
+                raise Exception('Sampling plan records outside the border of tile {}'.format(tile))
+            data[group] = data_batch
+            label[group] = label_batch
+        return data, label
+
+
+    def extract_record_labels(self, dataset, records, rotation, label_noise=0.0):
+        '''
+        Labels of sampling plan records, the same as extract_records returns, without extracting the data.
+        '''
+        label = np.empty((len(records), self.dim_label*self.dim_label), dtype=self.dtype)
+        for group, tile, noise_seed in Creator._group_records(records):
+            group_records = records[group]
+            if noise_seed >= 0:
+                label_img = dataset.open_noisy_label(tile, label_noise, noise_seed)
+            else:
+                label_img = dataset.open_arrays(tile)[1]
+            label[group] = self._extract_labels(label_img, group_records['y'], group_records['x'],
+                                                group_records['angle'], group_records['flip'], rotation, rotation)
+        return label
+
+
+    @staticmethod
+    def _group_records(records):
+        #All records of the same tile and label noise are extracted together.
+        order = np.lexsort((records['noise_seed'], records['tile']))
+        keys = records[['tile', 'noise_seed']][order]
+        bounds = np.flatnonzero((keys['tile'][1:] != keys['tile'][:-1]) |
+                                (keys['noise_seed'][1:] != keys['noise_seed'][:-1])) + 1
+        for group in np.split(order, bounds):
+            if len(group) > 0:
+                yield group, int(records['tile'][group[0]]), int(records['noise_seed'][group[0]])
+
+
+    def get_rotation_window(self):
+        '''
+        Side of the window that contains a patch rotated by any angle around the window center. Has the same parity as
+        the patch, so the patch and label stay centered in the window.
+        '''
+        window = int(np.ceil((self.dim_data - 1) * np.sqrt(2))) + 2
+        return window + (window - self.dim_data) % 2
+
+
+    def _draw_positions(self, dataset, image_idx, nr_samples, mixed_labels, window, noise, stats):
+        '''
+        Draws top-left positions of window x window areas from indices of valid positions. When mixing labels,
+        positions with and without road in the centered label crop are drawn directly, so no candidates are rejected to
+        keep the balance, regardless of how little of the tile is covered by roads. The number of road positions brings
+        the running counts in stats to mix_ratio, so a shortfall of tiles with few or no roads is made up by the next
+        tiles. Indices are kept on the dataset, per (level, seed) noise pair for noisy labels.
+        :return: Arrays of y and x coordinates
+        '''
+        if not mixed_labels:
+            return dataset.get_position_index(image_idx, window).sample(nr_samples)
+
+        #For rotated patches the road test uses the unrotated label crop, which is close enough to keep the balance.
+        road, other = dataset.get_class_indices(image_idx, window, self.dim_label, noise=noise)
+
+        #Tiles without roads only contribute their share of non-road patches, and the road patches they lack are drawn
+        #from the next tiles.
+        nr_road = int(round(self.mix_ratio * (stats['total'] + nr_samples) - stats['class']))
+        nr_road = min(max(nr_road, 0), nr_samples)
+        ys_road, xs_road = road.sample(nr_road)
+        ys_other, xs_other = other.sample(nr_samples - nr_road)
+        order = np.random.permutation(len(ys_road) + len(ys_other))
+        return np.concatenate((ys_road, ys_other))[order], np.concatenate((xs_road, xs_other))[order]
+
+
+    def _extract(self, image_img, label_img, nr_samples, rotation):
+        '''
+        Extracts up to nr_samples candidate patches from an opened image, one patch at a time. Patches outside the
+        border (transparent pixels) or without content are dropped.
+        :return: data and label candidates, and the number of dropped patches
+        '''
+        dim_data = self.dim_data
+        dim_label = self.dim_label
+        width = image_img.shape[1] - dim_data
+        height = image_img.shape[0] - dim_data
+
+        data = np.empty((nr_samples, dim_data*dim_data*3), dtype=self.dtype)
+        label = np.empty((nr_samples, dim_label*dim_label), dtype=self.dtype)
+        padding = (dim_data - dim_label) // 2
+        dropped = 0
+        idx = 0
+        for i in range(nr_samples):
+            x = random.randint(0, width)
+            y = random.randint( 0, height)
+
+            data_temp =     image_img[y : y+dim_data, x : x+dim_data]
+            label_temp =    label_img[y : y+dim_data, x : x+dim_data]
+
+            if self.img_have_alpha:
+                alpha_min = np.amin(data_temp[0: dim_data, 0: dim_data, 3])
+                if alpha_min <= 0:
+                    #If a single pixel is transparent, the patch is outside the border.
+                    dropped += 1
+                    continue
+                #Convert to RGB
+
+                data_temp = data_temp[0: dim_data, 0: dim_data, 0:3]
+
+            #TODO: new config parameter
+            if(rotation):
+                # Increase diversity of samples by flipping horizontal and vertical.
+                # Smart for aerial imagery, because you can flip in two directions.
+                # For natural imagery (sky etc) horizontal flips is bad. Characters all flips are probably bad.
+                choice = random.randint(0, 2)
+                if choice == 0:
+                    data_temp = np.flipud(data_temp)
+                    label_temp = np.flipud(label_temp)
+                elif choice == 1:
+                    data_temp = np.fliplr(data_temp)
+                    label_temp = np.fliplr(label_temp)
+                #Otherwise no further agumentation (choice == 2)
+
+            if self.compact:
+                data_sample =   util.from_rgb_batch_to_bytes(data_temp[np.newaxis])[0]
+                label_sample =  label_temp[padding: padding+dim_label, padding: padding+dim_label].reshape(-1)
+            else:
+                data_sample =   util.from_rgb_to_arr(data_temp)
+                label_sample =  util.create_image_label(label_temp, dim_data, dim_label)
+
+                if self.preprocessing:
+                    data_sample = util.normalize(data_sample, self.std)
+
+            if not self.img_have_alpha and data_sample.max() == data_sample.min():
+                #RGB only. Only filters out entirely white or black areas. Will filter out a whole lot of images.
+                dropped += 1
+                continue
+
+            data[idx] = data_sample
+            label[idx] = label_sample
+            idx += 1
+
+        return data[:idx], label[:idx], dropped
+
+
+    def _extract_batch(self, image_img, label_img, nr_samples, rotation, positions=None, rotate_patches=False,
+                       angles=None, choice=None):
+        '''
+        Batched version of _extract. All candidate coordinates for the opened image are drawn at once, gathered from
+        a strided view, and filtered, flipped and normalized as whole-array operations. If positions drawn from an
+        index of valid positions are supplied, no patches are dropped because of transparency. With rotate_patches,
+        the positions are the top-left corners of rotation windows, and every patch is cropped with its own angle
+        around the window center. Angles and flip choices are drawn at random, unless given.
+        :return: data and label candidates, the number of dropped patches, and the records of the candidates
+        '''
+        dim_data = self.dim_data
+
+        if positions is not None:
+            ys, xs = positions
+        else:
+            xs = np.random.randint(0, image_img.shape[1] - dim_data + 1, nr_samples)
+            ys = np.random.randint(0, image_img.shape[0] - dim_data + 1, nr_samples)
+
+        dropped = 0
+        if rotate_patches:
+            center = (self.get_rotation_window() - 1) / 2.0
+            if angles is None:
+                angles = np.random.uniform(0.0, 2 * np.pi, len(ys))
+            data_temp = util.extract_rotated_patches(image_img, ys + center, xs + center, angles, dim_data)
+            #The index keeps the window inside the border, but the warped patch is checked as well.
+            inside = data_temp[:, :, :, 3].min(axis=(1, 2)) > 0
+            dropped = len(ys) - np.count_nonzero(inside)
+            data_temp = data_temp[inside, :, :, 0:3]
+            ys = ys[inside]
+            xs = xs[inside]
+            angles = angles[inside]
+            if choice is not None:
+                choice = choice[inside]
+        else:
+            angles = np.zeros(len(ys))
+            data_temp = util.extract_patches(image_img, ys, xs, dim_data)
+            if positions is not None:
+                data_temp = data_temp[:, :, :, 0:3]
+            elif self.img_have_alpha:
+                #If a single pixel is transparent, the patch is outside the border.
+                inside = data_temp[:, :, :, 3].min(axis=(1, 2)) > 0
+                dropped = nr_samples - np.count_nonzero(inside)
+                data_temp = data_temp[inside, :, :, 0:3]
+                ys = ys[inside]
+                xs = xs[inside]
+
+        if not rotation:
+            choice = np.full(data_temp.shape[0], 2, dtype=np.int8)
+        elif choice is None:
+            choice = np.random.randint(0, 3, data_temp.shape[0])
+        if rotation:
+            data_temp = util.flip_patches(data_temp, choice)
+        label = self._extract_labels(label_img, ys, xs, angles, choice, rotate_patches, rotation)
+
+        records = create_records(data_temp.shape[0])
+        records['y'] = ys
+        records['x'] = xs
+        records['angle'] = angles
+        records['flip'] = choice
+
+        if self.compact:
+            data = util.from_rgb_batch_to_bytes(data_temp)
+        else:
+            data = util.from_rgb_batch_to_arr(data_temp)
+
+            if self.preprocessing:
+                data = util.normalize_batch(data, self.std)
+
+        if not self.img_have_alpha:
+            #RGB only. Only filters out entirely white or black areas
+            content = data.max(axis=1) != data.min(axis=1)
+            dropped += data.shape[0] - np.count_nonzero(content)
+            data = data[content]
+            label = label[content]
+            records = records[content]
+
+        return data, label, dropped, records
+
+
+    def _extract_labels(self, label_img, ys, xs, angles, choice, rotate_patches, rotation):
+        '''
+        Label patches at the positions _extract_batch extracts the data from, with the same rotation and flip.
+        '''
+        dim_label = self.dim_label
+        if rotate_patches:
+            center = (self.get_rotation_window() - 1) / 2.0
+            label_temp = util.extract_rotated_patches(label_img, ys + center, xs + center, angles, dim_label)
+        else:
+            padding = (self.dim_data - dim_label) // 2
+            label_temp = util.extract_patches(label_img, ys + padding, xs + padding, dim_label)
+        if rotation:
+            #Flipping the centered label crop is the same as cropping the flipped label patch.
+            label_temp = util.flip_patches(label_temp, choice)
+        if self.compact:
+            return label_temp.reshape(label_temp.shape[0], dim_label * dim_label)
+        return util.create_label_batch(label_temp)
+
+
+    def _create_batch(self, nr_examples, plan=False):
+        if plan:
+            return create_records(nr_examples), np.empty((nr_examples, self.dim_label*self.dim_label), dtype=self.dtype)
+        data = np.empty((nr_examples, self.dim_data*self.dim_data*3), dtype=self.dtype)
+        label = np.empty((nr_examples, self.dim_label*self.dim_label), dtype=self.dtype)
+        return data, label
+
+
+    @staticmethod
+    def create_stats():
+        #Class count starts at 0 of 1, so the first non-road patches are rejected when mixing labels.
+        return {'class': 0, 'total': 1, 'dropped': 0, 'curriculum_dropped': 0, 'curriculum_road_dropped': 0}
+
+
+    @staticmethod
+    def print_stats(dataset, nr_examples, stats, curriculum=None):
+        nr_class = stats['class']
+        nr_total = stats['total']
+        curriculum_dropped = stats['curriculum_dropped']
+        curriculum_road_dropped = stats['curriculum_road_dropped']
+        print("---- Extracted {} images from {}".format(nr_examples, dataset.name))
         print("---- Images containing class {}/{}, which is {}%".format(nr_class, nr_total, nr_class*100/float(nr_total)))
-        print("---- Dropped {} images".format(dropped_images))
+        print("---- Dropped {} images".format(stats['dropped']))
 
         if curriculum:
             print("---- Dropped {} patches because of curriculum".format(curriculum_dropped))
@@ -239,12 +611,6 @@ class Creator(object):
             else:
                 print("---- {} road patches dropped".format(curriculum_road_dropped))
                 print("---- Dropped {} road patches because of curriculum".format(curriculum_road_dropped/float(curriculum_dropped)))
-        #print('---- Creating permutation')
-        #perm = np.random.permutation(len(data))
-        #data = data[perm]
-        #label = label[perm]
-        #print('Examples shuffled')
-        return data, label
 
 
     def print_verbose(self):
@@ -252,6 +618,8 @@ class Creator(object):
         print('---- Data size {}x{}'.format( self.dim_data, self.dim_data))
         print('---- Label size {}x{}'.format( self.dim_label, self.dim_label))
         print('---- Rotation: {}, preprocessing: {}, and with std: {}'.format(self.rotation, self.preprocessing, self.std))
+        print('---- Batched extraction: {}, sampling processes: {}'.format(self.batched, self.workers))
+        print('---- Compact uint8 storage: {}'.format(self.compact))
         if self.only_mixed_labels:
             print('---- CAUTION: will only include labels containing class of interest')
             #print("Image that contains a lot of deadspace in terms of white or dark areas are dropped")
@@ -0,0 +1,78 @@
+__author__ = 'olav'
+
+from collections import OrderedDict
+
+
+class TileCache(object):
+    '''
+    Least recently used cache of decoded tiles, bounded by a memory budget in mb. A value is an array or a tuple of
+    arrays. Stored arrays are made read only, since the same array is handed out on every hit. Keeps track of hits and
+    misses, so the effect of the budget can be checked.
+    '''
+
+    def __init__(self, max_size):
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.set_size(max_size)
+
+
+    def set_size(self, max_size):
+        self.max_size = max_size
+        self.max_bytes = int(max_size * 1000000)
+        self._evict()
+
+
+    def get(self, key, load):
+        '''
+        Returns the value stored for key. On a miss, load is called to create it, and it is stored if it fits within the
+        budget.
+        '''
+        if key in self.items:
+            self.hits += 1
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+        self.misses += 1
+        value = load()
+        nbytes = TileCache._get_nbytes(value)
+        if nbytes <= self.max_bytes:
+            for arr in TileCache._get_arrays(value):
+                arr.flags.writeable = False
+            self.items[key] = value
+            self.nbytes += nbytes
+            self._evict()
+        return value
+
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+
+
+    def get_report(self):
+        return {'hits': self.hits, 'misses': self.misses, 'tiles': len(self.items), 'size': self.nbytes / 1000000.0}
+
+
+    def print_report(self):
+        report = self.get_report()
+        print('---- Tile cache: {} hits, {} misses, {} tiles using {}mb of {}mb'.format(
+            report['hits'], report['misses'], report['tiles'], report['size'], self.max_size))
+
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self.items:
+            key, value = self.items.popitem(last=False)
+            self.nbytes -= TileCache._get_nbytes(value)
+
+
+    @staticmethod
+    def _get_arrays(value):
+        return value if isinstance(value, tuple) else (value,)
+
+
+    @staticmethod
+    def _get_nbytes(value):
+        return sum(arr.nbytes for arr in TileCache._get_arrays(value))
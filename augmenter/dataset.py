@@ -1,28 +1,132 @@
-import os, sys
+import os, sys, random, zlib
+import numpy as np
 from PIL import Image, ImageFilter
 
 import augmenter.util as util
+from store import TileStore
+from index import PositionIndex, create_class_indices
 
 class Dataset(object):
     '''
     Helper object, that uses os methods to check validity of test, valid or train dataset.
-    Collect all image files and base path. Reduce property used to limit the sampling rate.
+    Collect all image files and base path. Reduce property used to limit the sampling rate. Decoded images can be
+    kept in a TileCache, which may be shared between datasets. If base is a TileStore, the pre-decoded tiles are
+    memory-mapped instead, and no cache is needed. Noisy labels are kept in the cache, and in noise_path if given, so
+    they are reused across runs.
     '''
-    def __init__(self, name, base, folder, reduce):
+    def __init__(self, name, base, folder, reduce, cache=None, noise_path=None):
         self.name = name
+        self.root = base
         self.base = os.path.join(base, folder)
-        self.img_paths = self._get_image_files(self.base)
+        self.folder = folder
+        self.store = None
+        if TileStore.is_store(base):
+            self.store = TileStore(base)
+            self.img_paths = [(tile['name'], tile['name']) for tile in self.store.get_tiles(folder)]
+        else:
+            self.img_paths = self._get_image_files(self.base)
         self.reduce = reduce
         self.nr_img = len(self.img_paths)
+        self.cache = cache
+        self.noise_path = noise_path
+        self.indices = {}
 
 
     def open_image(self, i):
+        if self.store:
+            image_arr, label_arr = self.store.open_tile(self.folder, i)
+            return Image.fromarray(image_arr, 'RGBA'), Image.fromarray(label_arr, 'L')
+
         image_path, label_path = self.img_paths[i]
         im = Image.open(os.path.join(self.base, 'data',  image_path), 'r').convert('RGBA')
         la = Image.open(os.path.join(self.base, 'labels',  label_path), 'r').convert('L')
         return im, la
 
 
+    def open_arrays(self, i):
+        '''
+        Decoded image i as uint8 arrays. RGBA data with shape (height, width, 4) and label with shape (height, width).
+        Repeated visits are served from the cache.
+        '''
+        if self.store:
+            return self.store.open_tile(self.folder, i)
+        if not self.cache:
+            return self._decode(i)
+        return self.cache.get((self.base, i), lambda: self._decode(i))
+
+
+    def open_noisy_label(self, i, level, seed):
+        '''
+        Label of image i with omission noise removing level of the roads. The noise only depends on the tile, the level
+        and the seed, so it is created once, and then served from the cache or from noise_path. Without noise, the
+        clean label is returned, and no copy of it is stored.
+        '''
+        if level <= 0:
+            return self.open_arrays(i)[1]
+        if not self.cache:
+            return self._load_noisy_label(i, level, seed)
+        key = ('noise', self.base, i, level, seed)
+        return self.cache.get(key, lambda: self._load_noisy_label(i, level, seed))
+
+
+    def get_position_index(self, i, dim):
+        '''
+        Index of the valid top-left positions of dim x dim patches in image i. Built once from the alpha channel.
+        '''
+        if (i, dim) not in self.indices:
+            image_arr, label_arr = self.open_arrays(i)
+            self.indices[(i, dim)] = PositionIndex.from_alpha(image_arr[:, :, 3], dim)
+        return self.indices[(i, dim)]
+
+
+    def get_class_indices(self, i, dim_data, dim_label, noise=None):
+        '''
+        Indices of valid positions in image i with and without road in the label crop. Built once from the alpha
+        channel and the label. If noise is a (level, seed) pair, the noisy label is used instead.
+        '''
+        key = ('class', i, dim_data, dim_label, noise)
+        if key not in self.indices:
+            image_arr, label_arr = self.open_arrays(i)
+            if noise:
+                label_arr = self.open_noisy_label(i, *noise)
+            self.indices[key] = create_class_indices(image_arr[:, :, 3], label_arr, dim_data, dim_label)
+        return self.indices[key]
+
+
+    def _decode(self, i):
+        im, la = self.open_image(i)
+        return np.array(im), np.array(la)
+
+
+    def _load_noisy_label(self, i, level, seed):
+        name = os.path.splitext(self.img_paths[i][1])[0]
+        path = None
+        if self.noise_path:
+            #Datasets in different locations can have tiles with the same name.
+            source = zlib.crc32(os.path.abspath(self.root).encode('utf-8')) & 0xffffffff
+            path = os.path.join(self.noise_path, '{:08x}'.format(source), self.folder,
+                                '{}-{}-{}.npy'.format(name, level, seed))
+            if os.path.isfile(path):
+                return np.load(path)
+
+        rng = random.Random(zlib.crc32('{}-{}-{}'.format(seed, name, level).encode('utf-8')) & 0xffffffff)
+        image_arr, label_arr = self.open_arrays(i)
+        noisy, p_removed = util.add_omission_noise(label_arr, level, rng)
+
+        if path:
+            #Written under a temporary name first, other processes might be creating the same label.
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as fp:
+                np.save(fp, noisy)
+            os.rename(tmp_path, path)
+        return noisy
+
+
     def _get_image_files(self, path):
         '''
         Each path should contain a data and labels folder containing images.
@@ -0,0 +1,68 @@
+__author__ = 'olav'
+
+import numpy as np
+
+
+def window_sums(mask, dim):
+    '''
+    Sum of mask inside every dim x dim window, computed from a summed-area table. Element (y, x) of the result is the
+    sum of the window with top-left corner at (y, x).
+    '''
+    height, width = mask.shape
+    table = np.zeros((height + 1, width + 1), dtype=np.int32)
+    np.cumsum(np.cumsum(mask, axis=0, dtype=np.int32), axis=1, out=table[1:, 1:])
+    return table[dim:, dim:] - table[:-dim, dim:] - table[dim:, :-dim] + table[:-dim, :-dim]
+
+
+class PositionIndex(object):
+    '''
+    Set of valid top-left positions for patches in a tile. The positions are stored as runs of valid positions per row,
+    which keeps the index small, since valid areas are mostly contiguous. Positions are drawn uniformly from the set.
+    '''
+
+    def __init__(self, mask):
+        height, width = mask.shape
+        padded = np.zeros((height, width + 2), dtype=np.int8)
+        padded[:, 1:-1] = mask
+        edges = np.diff(padded, axis=1)
+        self.rows, self.starts = np.nonzero(edges == 1)
+        ends = np.nonzero(edges == -1)[1]
+        lengths = ends - self.starts
+        self.offsets = np.cumsum(lengths) - lengths
+        self.size = int(lengths.sum())
+
+
+    @staticmethod
+    def from_alpha(alpha, dim):
+        '''
+        Index of the dim x dim windows of a tile without a single transparent pixel.
+        '''
+        return PositionIndex(window_sums(alpha == 0, dim) == 0)
+
+
+    def __len__(self):
+        return self.size
+
+
+    def sample(self, n):
+        '''
+        Draws n positions uniformly, with replacement. An empty index gives no positions.
+        :return: Arrays of y and x coordinates
+        '''
+        if self.size == 0:
+            return self.rows[0:0], self.starts[0:0]
+        draw = np.random.randint(0, self.size, n)
+        run = np.searchsorted(self.offsets, draw, side='right') - 1
+        return self.rows[run], self.starts[run] + (draw - self.offsets[run])
+
+
+def create_class_indices(alpha, label, dim_data, dim_label):
+    '''
+    Splits the valid positions of a tile in two indices. Positions where the centered dim_label x dim_label label crop
+    contains road, and positions where it does not.
+    '''
+    valid = window_sums(alpha == 0, dim_data) == 0
+    padding = (dim_data - dim_label) // 2
+    height, width = valid.shape
+    roads = window_sums(label > 0, dim_label)[padding: padding + height, padding: padding + width] > 0
+    return PositionIndex(valid & roads), PositionIndex(valid & ~roads)
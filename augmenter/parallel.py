@@ -0,0 +1,220 @@
+__author__ = 'olav'
+
+import multiprocessing as mp
+import random, zlib
+import numpy as np
+import theano
+
+from printing import print_error
+from plan import record_dtype
+
+'''
+Process pool sampling engine. Images are sharded across worker processes, and every worker writes its accepted
+patches straight into preallocated shared memory arrays. The parent process only moves rows around to close the
+gaps left by images that produced fewer patches than their quota. An image is sampled by the same worker in every
+round, so its decoded tile stays in the tile cache of that worker.
+'''
+
+#Set in each worker process by _init_worker.
+_worker = {}
+
+
+def _init_worker(creator, datasets, buffers, workers):
+    if creator.cache:
+        #Every worker has its own copy of the cache, so the memory budget is split between them. A worker only caches
+        #the tiles of its own share of the images.
+        creator.cache.set_size(creator.cache.max_size / float(workers))
+    _worker['creator'] = creator
+    _worker['datasets'] = datasets
+    _worker['views'] = [ParallelSampler.create_views(*b) for b in buffers]
+
+
+def _sample_task(task):
+    '''
+    Samples a single image in a worker process. The image is sampled with its own seed, so the result does not depend
+    on which worker ends up with the task.
+    '''
+    job, image_idx, offset, nr_samples, seed, counts, kwargs = task
+    random.seed(seed)
+    np.random.seed(seed)
+
+    creator = _worker['creator']
+    cache = (creator.cache.hits, creator.cache.misses) if creator.cache else (0, 0)
+    stats = creator.create_stats()
+    stats['class'], stats['total'] = counts
+    sampled = creator.sample_image(_worker['datasets'][job], image_idx, nr_samples, nr_samples, stats, **kwargs)
+
+    nr_accepted = sampled[0].shape[0]
+    for view, array in zip(_worker['views'][job], sampled):
+        view[offset: offset + nr_accepted] = array
+
+    #Only report what this image contributed to the running counts.
+    stats['class'] -= counts[0]
+    stats['total'] -= counts[1]
+    if creator.cache:
+        cache = (creator.cache.hits - cache[0], creator.cache.misses - cache[1])
+    return job, offset, nr_accepted, stats, cache
+
+
+class ParallelSampler(object):
+    '''
+    Samples several patch datasets concurrently with a pool of worker processes. Sampling happens in rounds. Each round
+    every image of a dataset gets a quota and a slot range in the shared arrays. After the round, the accepted patches
+    are compacted, and the next round samples the remainder with a reduced quota, like the rotating queue in
+    Creator.sample_data. Each worker is a pool of a single process, and image i of a dataset always goes to worker
+    i modulo the number of workers. A shared pool hands the images to whichever worker is free, so with the cache
+    budget split between the workers, almost every round would decode the tiles again.
+    '''
+    max_empty_rounds = 10
+
+    def __init__(self, creator, workers, seed=0):
+        self.creator = creator
+        self.workers = workers
+        self.seed = seed
+
+
+    def sample(self, jobs):
+        '''
+        :param jobs: List of (dataset, samples_per_image, sample_image keyword arguments).
+        :return: List of (data, label) for each job, in the same order. (data, label, records) for jobs with
+        keep_records.
+        '''
+        dim_data = self.creator.dim_data
+        dim_label = self.creator.dim_label
+        datasets = []
+        buffers = []
+        splits = []
+        for job, (dataset, samples_per_image, kwargs) in enumerate(jobs):
+            quota = int(samples_per_image * dataset.reduce)
+            capacity = dataset.nr_img * quota
+            buffer = ParallelSampler.create_buffer(capacity, dim_data*dim_data*3, dim_label*dim_label,
+                                                   self.creator.dtype, records=kwargs.get('keep_records', False))
+            datasets.append(dataset)
+            buffers.append(buffer)
+            splits.append({
+                'job': job,
+                'dataset': dataset,
+                'quota': quota,
+                'capacity': capacity,
+                'filled': 0,
+                'round': 0,
+                'empty_rounds': 0,
+                'done': capacity == 0,
+                'views': ParallelSampler.create_views(*buffer),
+                'stats': self.creator.create_stats(),
+                'kwargs': kwargs
+            })
+            print('Sampling examples for {} with {} workers'.format(dataset.base, self.workers))
+
+        pools = [mp.Pool(1, initializer=_init_worker, initargs=(self.creator, datasets, buffers, self.workers))
+                 for worker in range(self.workers)]
+        cache = [0, 0]
+        try:
+            while not all(split['done'] for split in splits):
+                tasks = []
+                for split in splits:
+                    if not split['done']:
+                        tasks.extend(self._create_tasks(split))
+
+                results = [[] for split in splits]
+                pending = [pools[task[1] % self.workers].apply_async(_sample_task, (task,)) for task in tasks]
+                for result in pending:
+                    job, offset, nr_accepted, stats, task_cache = result.get()
+                    results[job].append((offset, nr_accepted))
+                    for key in stats:
+                        splits[job]['stats'][key] += stats[key]
+                    cache[0] += task_cache[0]
+                    cache[1] += task_cache[1]
+
+                for split in splits:
+                    if not split['done']:
+                        self._compact(split, results[split['job']])
+        finally:
+            for pool in pools:
+                pool.close()
+            for pool in pools:
+                pool.join()
+
+        if self.creator.cache:
+            print('---- Tile cache of the workers: {} hits, {} misses'.format(cache[0], cache[1]))
+
+        sampled = []
+        for split in splits:
+            self.creator.print_stats(split['dataset'], split['filled'], split['stats'])
+            sampled.append(tuple(view[:split['filled']] for view in split['views']))
+        return sampled
+
+
+    def _create_tasks(self, split):
+        dataset = split['dataset']
+        image_queue = list(range(dataset.nr_img))
+        random.Random(self._get_seed(dataset, split['round'], -1)).shuffle(image_queue)
+        counts = (split['stats']['class'], split['stats']['total'])
+
+        #Spread the remaining examples over all images, so the last rounds still use every worker.
+        remaining = split['capacity'] - split['filled']
+        quota = min(split['quota'], max(10, -(-remaining // dataset.nr_img)))
+
+        tasks = []
+        reserved = split['filled']
+        for image_idx in image_queue:
+            nr_samples = min(quota, split['capacity'] - reserved)
+            if nr_samples <= 0:
+                break
+            seed = self._get_seed(dataset, split['round'], image_idx)
+            tasks.append((split['job'], image_idx, reserved, nr_samples, seed, counts, split['kwargs']))
+            reserved += nr_samples
+        return tasks
+
+
+    def _compact(self, split, results):
+        '''
+        Moves the accepted rows of each task down to close the gaps. Rows only move towards the start of the arrays,
+        and tasks are handled in offset order, so nothing is overwritten before it has been moved.
+        '''
+        write = split['filled']
+        for offset, nr_accepted in sorted(results):
+            if offset != write:
+                for view in split['views']:
+                    view[write: write + nr_accepted] = view[offset: offset + nr_accepted]
+            write += nr_accepted
+
+        #Small rounds can come up empty when mixing labels, but not forever.
+        split['empty_rounds'] = split['empty_rounds'] + 1 if write == split['filled'] else 0
+        if split['empty_rounds'] >= ParallelSampler.max_empty_rounds:
+            print_error('No examples accepted from {} in {} rounds. Stopping at {} examples'.format(
+                split['dataset'].name, split['empty_rounds'], write))
+            split['done'] = True
+        split['filled'] = write
+        split['round'] += 1
+        split['done'] = split['done'] or split['filled'] >= split['capacity']
+
+        # Reduce samples per image after first pass through
+        if not split['kwargs'].get('mixed_labels'):
+            split['quota'] = max(10, int(split['quota']*0.9))
+        print('---- {} round {}. Patches remaining: {}'.format(
+            split['dataset'].name, split['round'], split['capacity'] - split['filled']))
+
+
+    def _get_seed(self, dataset, round, image_idx):
+        key = '{}-{}-{}-{}'.format(self.seed, dataset.name, round, image_idx)
+        return zlib.crc32(key.encode('utf-8')) & 0xffffffff
+
+
+    @staticmethod
+    def create_buffer(rows, data_length, label_length, dtype=theano.config.floatX, records=False):
+        #With records, the sampling plan records of the examples get a buffer as well.
+        itemsize = np.dtype(dtype).itemsize
+        data = mp.RawArray('b', rows * data_length * itemsize)
+        label = mp.RawArray('b', rows * label_length * itemsize)
+        record_buffer = mp.RawArray('b', rows * record_dtype.itemsize) if records else None
+        return data, label, data_length, label_length, np.dtype(dtype).str, record_buffer
+
+
+    @staticmethod
+    def create_views(data, label, data_length, label_length, dtype, records=None):
+        data_view = np.frombuffer(data, dtype=dtype).reshape(-1, data_length)
+        label_view = np.frombuffer(label, dtype=dtype).reshape(-1, label_length)
+        if records is None:
+            return data_view, label_view
+        return data_view, label_view, np.frombuffer(records, dtype=record_dtype)
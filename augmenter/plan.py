@@ -0,0 +1,89 @@
+__author__ = 'olav'
+
+import os, json
+import numpy as np
+
+#A patch is defined by its tile and the top-left position of the sampling window in the tile. For rotated sets the
+#window is the rotation window, and angle and flip are the augmentation applied. Noise seed is -1 for clean labels.
+record_dtype = np.dtype([
+    ('tile', np.int32),
+    ('y', np.int32),
+    ('x', np.int32),
+    ('angle', np.float64),
+    ('flip', np.int8),
+    ('noise_seed', np.int64),
+    ('stage', np.int16)
+])
+
+
+def create_records(nr_records):
+    return np.zeros(nr_records, dtype=record_dtype)
+
+
+class SamplingPlan(object):
+    '''
+    Patch dataset stored as the sampling decisions instead of the pixels. Every set and stage holds an array of
+    records, and the patches are rebuilt from the tiles of the source dataset when they are needed. A manifest lists
+    the source, the patch dimensions and the tiles of each set, so a plan can be checked against the tiles it is
+    rebuilt from.
+    Layout: <plan>/plan.json, <plan>/train/<stage>/plan.npy, <plan>/valid/plan.npy and <plan>/test/plan.npy
+    '''
+    manifest_name = 'plan.json'
+    records_name = 'plan.npy'
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, SamplingPlan.manifest_name)) as fp:
+            self.manifest = json.load(fp)
+
+
+    @staticmethod
+    def is_plan(path):
+        return os.path.isfile(os.path.join(path, SamplingPlan.manifest_name))
+
+
+    @staticmethod
+    def create(path, creator, rotation, label_noise=0.0):
+        '''
+        Writes the manifest of a plan sampled by creator. The datasets of creator must be loaded.
+        :param rotation: Sets sampled with rotation. Records of these sets have rotation window positions.
+        '''
+        manifest = {
+            'version': SamplingPlan.version,
+            'source': os.path.abspath(creator.dataset_path),
+            'dim': [creator.dim_data, creator.dim_label],
+            'label_noise': label_noise,
+            'sets': {}
+        }
+        for set_name, dataset in [('train', creator.train), ('valid', creator.valid), ('test', creator.test)]:
+            manifest['sets'][set_name] = {
+                'tiles': [os.path.splitext(label)[0] for image, label in dataset.img_paths],
+                'rotation': set_name in rotation
+            }
+        with open(os.path.join(path, SamplingPlan.manifest_name), 'w') as fp:
+            json.dump(manifest, fp, indent=1)
+        return SamplingPlan(path)
+
+
+    def get_records_path(self, set_name, stage=None):
+        if stage is not None:
+            return os.path.join(self.path, set_name, stage, SamplingPlan.records_name)
+        return os.path.join(self.path, set_name, SamplingPlan.records_name)
+
+
+    def load_records(self, set_name, stage=None):
+        return np.load(self.get_records_path(set_name, stage))
+
+
+    def has_rotation(self, set_name):
+        return self.manifest['sets'][set_name]['rotation']
+
+
+    def check_dataset(self, set_name, dataset):
+        '''
+        Raises an exception if dataset does not contain the tiles the records of set_name refer to.
+        '''
+        tiles = [os.path.splitext(label)[0] for image, label in dataset.img_paths]
+        if tiles != self.manifest['sets'][set_name]['tiles']:
+            raise Exception('Tiles of {} does not match the sampling plan'.format(dataset.base))
@@ -0,0 +1,79 @@
+__author__ = 'olav'
+
+import os, json
+import numpy as np
+
+import augmenter.util as util
+
+
+class TileStore(object):
+    '''
+    Pre-decoded aerial image dataset. Every tile is stored as an uint8 .npy file with shape (height, width, 5), holding
+    the RGB, alpha and label planes. Tiles are opened memory-mapped, so reading a patch is a page cache hit instead of
+    an image decode, and concurrent runs on the same machine share the same physical pages. A manifest in the
+    store folder lists the tiles of each set.
+    Layout: <store>/manifest.json and <store>/<set>/<tile>.npy
+    '''
+    manifest_name = 'manifest.json'
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, TileStore.manifest_name)) as fp:
+            self.manifest = json.load(fp)
+
+
+    @staticmethod
+    def is_store(path):
+        return os.path.isfile(os.path.join(path, TileStore.manifest_name))
+
+
+    def get_tiles(self, set_name):
+        return self.manifest['sets'][set_name]
+
+
+    def open_tile(self, set_name, i):
+        '''
+        Memory-mapped tile i of set_name, split in a RGBA and label view.
+        '''
+        tile = self.get_tiles(set_name)[i]
+        arr = np.load(os.path.join(self.path, tile['file']), mmap_mode='r')
+        return arr[:, :, 0:4], arr[:, :, 4]
+
+
+    @staticmethod
+    def create(dataset_path, store_path):
+        '''
+        One-time conversion of a dataset folder with train, valid and test sets, each containing data and labels, to a
+        tile store.
+        '''
+        #Imported here, dataset.py needs this module to open stores.
+        from dataset import Dataset
+
+        if os.path.exists(store_path):
+            raise Exception('Store path already exists')
+        os.makedirs(store_path)
+
+        manifest = {'version': TileStore.version, 'source': os.path.abspath(dataset_path), 'sets': {}}
+        for set_name in util.get_dataset(dataset_path):
+            dataset = Dataset(set_name, dataset_path, set_name, 1)
+            os.makedirs(os.path.join(store_path, set_name))
+            tiles = []
+            for i in range(dataset.nr_img):
+                image_arr, label_arr = dataset.open_arrays(i)
+                tile = np.empty(image_arr.shape[0:2] + (5,), dtype=np.uint8)
+                tile[:, :, 0:4] = image_arr
+                tile[:, :, 4] = label_arr
+
+                name = os.path.splitext(dataset.img_paths[i][0])[0]
+                file_name = os.path.join(set_name, name + '.npy')
+                np.save(os.path.join(store_path, file_name), tile)
+                tiles.append({'name': name, 'file': file_name, 'shape': list(tile.shape[0:2])})
+                if (i + 1) % 50 == 0:
+                    print('---- {}: {}/{}'.format(set_name, i + 1, dataset.nr_img))
+
+            manifest['sets'][set_name] = tiles
+            print('---- Stored {} tiles from {}'.format(len(tiles), set_name))
+
+        with open(os.path.join(store_path, TileStore.manifest_name), 'w') as fp:
+            json.dump(manifest, fp, indent=1)
@@ -12,6 +12,14 @@ def normalize(data, std):
     data = (data - m) / std
     return data
 
+def normalize_batch(data, std):
+    '''
+    Contrast normalizes every row of data in place. Same operation as normalize, but for a whole batch of patches.
+    '''
+    data -= np.mean(data, axis=1, keepdims=True)
+    data /= std
+    return data
+
 def get_image_files(path):
         print('Retrieving {}'.format(path))
         included_extenstions = ['jpg','png', 'tiff', 'tif']
@@ -21,7 +29,8 @@ def get_image_files(path):
 
 
 def get_dataset(path):
-    content = os.listdir(path)
+    #Tile stores keep a manifest next to the sets.
+    content = [x for x in os.listdir(path) if not x.endswith('.json')]
     if not all(x in ['train', 'valid', 'test'] for x in content):
         print_error('Folder does not contain image or label folder. Path probably not correct')
         raise Exception('Fix dataset_path in config')
@@ -54,6 +63,81 @@ def from_rgb_to_arr(image):
     arr = arr.reshape(3 * arr.shape[1] * arr.shape[2])
     return arr
 
+def extract_patches(image, ys, xs, dim):
+    '''
+    Gathers dim x dim patches with top-left corners at (ys, xs) from image. A strided view of every possible window
+    is created without copying, and the patches are picked out of this view by fancy indexing.
+    :return: Array with shape (n, dim, dim) + image.shape[2:]
+    '''
+    image = np.asarray(image)
+    height, width = image.shape[0], image.shape[1]
+    shape = (height - dim + 1, width - dim + 1, dim, dim) + image.shape[2:]
+    strides = image.strides[:2] + image.strides[:2] + image.strides[2:]
+    windows = np.lib.stride_tricks.as_strided(image, shape=shape, strides=strides)
+    return windows[ys, xs]
+
+def extract_rotated_patches(image, cys, cxs, angles, dim):
+    '''
+    Gathers dim x dim patches centered at (cys, cxs), each rotated by its own angle in radians. The patch grid is
+    mapped through an affine rotation around the center, and the nearest pixel is picked, like PIL rotate does.
+    The caller must make sure the rotated patches are inside the image.
+    :return: Array with shape (n, dim, dim) + image.shape[2:]
+    '''
+    offsets = np.arange(dim) - (dim - 1) / 2.0
+    grid_y = offsets[:, np.newaxis]
+    grid_x = offsets[np.newaxis, :]
+    cos = np.cos(angles)[:, np.newaxis, np.newaxis]
+    sin = np.sin(angles)[:, np.newaxis, np.newaxis]
+    ys = np.rint(cys[:, np.newaxis, np.newaxis] + cos * grid_y - sin * grid_x).astype(np.intp)
+    xs = np.rint(cxs[:, np.newaxis, np.newaxis] + sin * grid_y + cos * grid_x).astype(np.intp)
+    return np.asarray(image)[ys, xs]
+
+def flip_patches(patches, choice):
+    '''
+    Flips patches in place. Choice 0 flips the patch vertically, choice 1 horizontally and choice 2 leaves it as is.
+    '''
+    up = choice == 0
+    patches[up] = patches[up, ::-1]
+    lr = choice == 1
+    patches[lr] = patches[lr, :, ::-1]
+    return patches
+
+def from_rgb_batch_to_arr(patches):
+    '''
+    Batch version of from_rgb_to_arr. Patches with shape (n, dim, dim, 3) is rescaled and reordered to channel first
+    rows with length 3*dim*dim.
+    '''
+    arr = np.asarray(patches, dtype='float32') / 255
+    arr = arr.transpose(0, 3, 1, 2)
+    return arr.reshape(arr.shape[0], arr.shape[1] * arr.shape[2] * arr.shape[3])
+
+def from_rgb_batch_to_bytes(patches):
+    '''
+    Compact version of from_rgb_batch_to_arr. Patches are reordered to channel first rows, but kept as uint8 without
+    rescaling. Decoded by decode_data when the examples are needed as floats.
+    '''
+    arr = np.asarray(patches, dtype=np.uint8).transpose(0, 3, 1, 2)
+    return arr.reshape(arr.shape[0], arr.shape[1] * arr.shape[2] * arr.shape[3])
+
+def decode_data(data, std, preprocessing, dtype='float32'):
+    '''
+    Float examples from compact uint8 examples. Rescaled to [0, 1], and contrast normalized if preprocessing is
+    enabled, which gives the same rows as sampling without compact storage.
+    '''
+    arr = np.asarray(data, dtype=dtype)
+    arr /= 255
+    if preprocessing:
+        arr = normalize_batch(arr, std)
+    return arr
+
+def decode_labels(labels, dtype='float32'):
+    '''
+    Float labels from compact uint8 labels.
+    '''
+    arr = np.asarray(labels, dtype=dtype)
+    arr /= 255
+    return arr
+
 def create_image_label(image, dim_data, dim_label):
         #TODO: Euclidiean to dist, ramp up to definite roads. Model label noise in labels?
         y_size = dim_label
@@ -68,6 +152,13 @@ def create_image_label(image, dim_data, dim_label):
         label = label / 255.0
         return label
 
+def create_label_batch(label_patches):
+    '''
+    Batch version of create_image_label. Expects label patches already cropped to dim_label x dim_label.
+    '''
+    label = label_patches.reshape(label_patches.shape[0], label_patches.shape[1] * label_patches.shape[2])
+    return label / 255.0
+
 def create_threshold_image(image, threshold):
     '''
     threshold value define the binary split. Resulting binary image only contains 0 and 1, while image contains
@@ -90,6 +181,45 @@ def get_road_position(image):
     arr = np.array(image)
     return np.where(arr == 255)
 
+def add_omission_noise(label, threshold, rng=random):
+    '''
+    Array version of the omission noise in add_artificial_road_noise. Ellipses centered on road pixels are filled with
+    background until threshold of the roads is removed. The number of removed pixels is only updated inside the
+    bounding box of each ellipse, instead of comparing the whole label with the original after every ellipse.
+    :param label: bw label array, not modified
+    :param rng: Source of randomness, random.Random instance or the random module
+    :return: noisy label array and the percentage of roads removed
+    '''
+    noisy = np.array(label)
+    height, width = noisy.shape
+    ys, xs = np.nonzero(noisy == 255)
+    nr_labels = ys.shape[0]
+
+    #If there are no road class there is no use in removing some.
+    if nr_labels == 0:
+        return noisy, 0
+
+    shape_max = int(width / 10)
+    shape_min = int(width / 20)
+    removed_threshold = np.clip(threshold, 0.0, 1.0)
+    nr_removed = 0
+    while nr_removed / float(nr_labels) < removed_threshold:
+        i = rng.randint(0, nr_labels - 1)
+        y = ys[i]
+        x = xs[i]
+        w = int(rng.randint(shape_min, shape_max)/2)
+        h = int(rng.randint(shape_min, shape_max)/2)
+
+        top, bottom = max(y - h, 0), min(y + h + 1, height)
+        left, right = max(x - w, 0), min(x + w + 1, width)
+        box = noisy[top: bottom, left: right]
+        dy = (np.arange(top, bottom) - y)[:, np.newaxis] / (h + 0.5)
+        dx = (np.arange(left, right) - x)[np.newaxis, :] / (w + 0.5)
+        hit = (dy*dy + dx*dx <= 1) & (box != 0)
+        nr_removed += np.count_nonzero(hit)
+        box[hit] = 0
+    return noisy, nr_removed / float(nr_labels)
+
 def add_artificial_road_noise(image, threshold):
     '''
     Adds artifical omission noise to label image, until threshold is reached.
@@ -98,52 +228,25 @@ def add_artificial_road_noise(image, threshold):
     :param threshold: Percentage of roads to be removed
     :return:
     '''
-    label = image.copy()
     random_noise = False
-    if random_noise:
-        nr_labels = image.size[0] * image.size[1]
-
-        pixels = label.load()
-        original_pixels = image.load()
-    else:
-        dr = ImageDraw.Draw(label)
-        nr_labels = np.sum(np.array(image) == 255)
-        shape_max = int(image.size[0] / 10)
-        shape_min = int(image.size[0]/20)
-        locations = get_road_position(label)
+    if not random_noise:
+        #Road pixels are removed systematically. Simulates omission noise
+        label, p_roads_removed = add_omission_noise(np.array(image), threshold)
+        return Image.fromarray(label), p_roads_removed
 
-    #If there are no road class there is no use in removing some.
-    if nr_labels == 0:
-        return label, 0
+    label = image.copy()
+    nr_labels = image.size[0] * image.size[1]
+    pixels = label.load()
+    original_pixels = image.load()
 
     removed_threshold = np.clip(threshold, 0.0, 1.0)
     p_roads_removed = 0.0
-    #t = 0
     while p_roads_removed < removed_threshold:
-        if random_noise:
-            #Randomly distribution noise
-            for i in range(1000):
-                y = random.randint(0, image.size[0]-1)
-                x = random.randint(0, image.size[1]-1)
-                pixels[x, y] = int(not bool(original_pixels[x, y])) * 255
-        else:
-            #Road pixels are removed systematically. Simulates omission noise
-            i = random.randint(0, locations[0].shape[0] -1 )
-            y = locations[0][i]
-            x = locations[1][i]
-            w = int(random.randint(shape_min, shape_max)/2)
-            h = int(random.randint(shape_min, shape_max)/2)
-
-            #if t%2 == 0:
-            cor = (x-w, y-h, x+w, y+h)
-            dr.ellipse(cor, fill="black")
-            #Failed attempt at registration noise
-            #else:
-            #    m = int(random.randint(-10, 10))
-            #    n = int(random.randint(-10, 10))
-            #    cropped = label.crop((x,y, x+w,y+h))
-             #   label.paste(cropped, (x-m, y-n, x+w-m, y+h-n) )
+        #Randomly distribution noise
+        for i in range(1000):
+            y = random.randint(0, image.size[0]-1)
+            x = random.randint(0, image.size[1]-1)
+            pixels[x, y] = int(not bool(original_pixels[x, y])) * 255
         nr_of_changes = get_sum_road(label, image)
         p_roads_removed = nr_of_changes/ float(nr_labels)
-        #t = t+1
-    return label, p_roads_removed
\ No newline at end of file
+    return label, p_roads_removed
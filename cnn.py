@@ -20,6 +20,7 @@ def run_cnn(model_params, optimization_params, dataset_path, dataset_params, fil
     is_curriculum, curriculum_set = interface.command.get_command("-curriculum")
     is_batch_run, batch_index = interface.command.get_command("-batch", default="0")
     is_init_params, param_path = interface.command.get_command("-params")
+    is_workers, sampling_workers = interface.command.get_command("-sampling_workers")
 
     if is_config:
         #Assume  config is speficially for running bootstrapping batches.
@@ -35,32 +36,61 @@ def run_cnn(model_params, optimization_params, dataset_path, dataset_params, fil
     if is_curriculum:
         dataset_path = curriculum_set
 
+    if is_workers:
+        dataset_params.sampling_workers = int(sampling_workers)
+
     weights = None
     if is_init_params:
-        store = ParamStorage()
-        if not param_path:
-            param_path = "./results/params.pkl"
-        weights = store.load_params(path=param_path)['params']
+        weights = load_init_params(param_path)
 
+    checkpoint_path = None
+    if is_batch_run:
+        #Concurrent batch runs must not overwrite each other's checkpoints.
+        checkpoint_path = get_checkpoint_path(filename_params, batch_index)
 
     dataset = DataLoader.create()
     dataset.load(dataset_path, dataset_params, optimization_params.batch_size) #Input stage
     model = ConvModel(model_params, verbose=True) #Create network stage
 
     evaluator = Evaluator(model, dataset, optimization_params, dataset_path)
-    evaluator.run(epochs=epochs,  verbose=verbose, init=weights)
+    evaluator.run(epochs=epochs,  verbose=verbose, init=weights, checkpoint_path=checkpoint_path)
+    dataset.destroy()
+
+    if not is_batch_run:
+        batch_index = None
+    store_run(evaluator, model_params, dataset_params, optimization_params, filename_params, visual_params,
+              batch_index)
+
+
+def get_checkpoint_path(filename_params, batch_index):
+    #The epoch is appended, for instance batch<index>-epoch20.pkl.
+    return filename_params.results + "/batch" + batch_index + "-epoch.pkl"
+
+
+def load_init_params(param_path):
+    store = ParamStorage()
+    if not param_path:
+        param_path = "./results/params.pkl"
+    return store.load_params(path=param_path)['params']
+
+
+def store_run(evaluator, model_params, dataset_params, optimization_params, filename_params, visual_params,
+              batch_index=None):
+    '''
+    Stores the params of a trained model, measures its precision and recall, and stores the results. With a batch
+    index, they are stored as batch<index>.pkl and batch<index>.json in the results folder.
+    '''
+    model = evaluator.model
     report = evaluator.get_result()
     network_store_path = filename_params.network_save_name
     result_path = filename_params.results + "/results.json"
-    if is_batch_run:
+    if batch_index is not None:
         network_store_path = filename_params.results + "/batch" + batch_index +  ".pkl"
         result_path =filename_params.results + "/batch" + batch_index +  ".json"
 
     storage = ParamStorage(path=network_store_path)
     storage.store_params(model.params)
 
-    dataset.destroy()
-
     if visual_params.gui_enabled:
          interface.server.stop_job(report)
 
@@ -74,16 +104,17 @@ def run_cnn(model_params, optimization_params, dataset_path, dataset_params, fil
 
     if visual_params.gui_enabled:
         interface.server.send_precision_recall_data(test_datapoints, valid_datapoints)
-    storage.store_result(result_path, evaluator.events, test_datapoints, valid_datapoints)
-
-
-run_cnn(
-    model_params            = model_params,
-    optimization_params     = optimization_params,
-    dataset_path            = dataset_path,
-    dataset_params          = dataset_params,
-    filename_params         = filename_params,
-    visual_params           = visual_params,
-    epochs                  = number_of_epochs,
-    verbose                 = verbose,
-)
\ No newline at end of file
+    storage.store_result(result_path, evaluator.events, test_datapoints, valid_datapoints, evaluator.epochs)
+
+
+if __name__ == "__main__":
+    run_cnn(
+        model_params            = model_params,
+        optimization_params     = optimization_params,
+        dataset_path            = dataset_path,
+        dataset_params          = dataset_params,
+        filename_params         = filename_params,
+        visual_params           = visual_params,
+        epochs                  = number_of_epochs,
+        verbose                 = verbose,
+    )
@@ -15,7 +15,8 @@ filename_params = Params({
         "results"               : "./results",
         "network_save_name"     : "./results/params.pkl",
         "curriculum_teacher"    : "/home/olav/Documents/Results/E7_inexperienced_teacher/teacher/params.pkl",
-        "curriculum_location"   : "/media/olav/Data storage/dataset/Mass_inexperienced_100-2-5-stages"
+        "curriculum_location"   : "/media/olav/Data storage/dataset/Mass_inexperienced_100-2-5-stages",
+        "function_cache"        : "./function_cache" #Compiled theano functions reused by later runs. None disables.
 
     })
 
@@ -51,22 +52,40 @@ optimization_params = Params({
 dataset_params = Params({
     "loader"                : "AerialDataset",
     "with_replacement"      : True, #True: random indexes in training set replaced 62% average. False: Entire training set replaced.
+    "mix_fraction"          : 1.0, #Fraction of the examples in a curriculum stage mixed into the training set.
+    "shard_size"            : 10000, #Examples per shard of pre-generated datasets. 0: a single memory-mapped examples.npy.
+    "shard_compression"     : True,
     "samples_per_image"     : 200,
     #"dataset_std"           : 0.18945282966287444, #Norwegian dataset
     "dataset_std"           : 0.18893923860059578, #Mass
     "valid_std"             : 0.19088566314428751, #Not used
     "test_std"              : 0.18411163301559019, #Not used
     "reduce_training"       : 1.0,
-    "reduce_testing"        : 0.5,
+    "reduce_testing"        : 1.0,
     "reduce_validation"     : 1.0,
     "use_rotation"          : True,
     "use_preprocessing"     : True,
+    "use_batched_sampling"  : True, #Extract patches per image as whole-array operations instead of one at a time.
+    "sampling_workers"      : 0, #Processes sampling the dataset. 0: one per cpu core, 1: sample in main process.
+    "sampling_seed"         : 1, #Per image seeds are derived from this when sampling with several processes.
+    "tile_cache_size"       : 4096, #Memory budget in mb for decoded aerial and label images. 0 disables the cache.
+    "compact_storage"       : True, #Keep sampled examples as uint8 in memory and on disk, decoded when moved to the GPU.
     "input_dim"             : 64,
     "output_dim"            : 16,
-    "chunk_size"            : 1024,
+    "chunk_size"            : "auto", #Mb per training chunk. auto: largest chunk that fits the device and host memory.
+    "device_memory"         : None, #Mb on the GPU for examples. None: free memory of the GPU when loading.
+    "host_memory_fraction"  : 0.5, #Fraction of the available host memory for training chunks.
+    "prefetch_chunks"       : True, #Prepare the next chunk on a background thread.
+    "stream_evaluation"     : True, #Move validation and test sets to the GPU in chunks, like the training set.
+    "shuffle_training"      : True, #Reorder the training examples across chunks every epoch.
 
     "use_label_noise"       : True,
     "label_noise"           : 0.0,
+    "label_noise_cache"     : "./label_noise_cache", #Noisy labels are stored here and reused by later runs. None disables.
+    "dataset_cache"         : "./dataset_cache", #Sampled datasets are stored here and reused by later runs. None disables.
+    "evaluation_sets"       : "./dataset_cache", #Frozen validation and test sets, also used by precision and recall. None disables.
+    "evaluation_samples_per_image": 200,
+    "plan_tile_path"        : None, #Dataset that sampling plans are rebuilt from. None: the dataset the plan was sampled from.
 
     "only_mixed_labels"     : True,
     "mix_ratio"             : 0.5
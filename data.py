@@ -1,5 +1,5 @@
 from abc import ABCMeta, abstractmethod
-import os, math,sys, random
+import os, math,sys, threading, timeit
 import numpy as np
 import theano
 import theano.tensor as T
@@ -7,6 +7,10 @@ import theano.tensor as T
 from config import dataset_params
 from printing import print_section, print_error
 from augmenter.aerial import Creator
+from augmenter.plan import SamplingPlan
+from storage.shards import ShardedSet, ShardedArray
+from storage.dataset_cache import DatasetCache, FrozenEvaluationSets
+import augmenter.util as util
 
 class DataLoader:
     '''
@@ -39,6 +43,14 @@ class AbstractDataset(object):
         self.active = []
         self.all_shared_hooks = [] #WHen casted, cannot set_value on them
         self.nr_examples = {}
+        self.std = 1
+        self.preprocessing = False
+        self.prefetcher = None
+        self.active_idx = 0 #Chunk in the active shared variables. None if it has to be switched in again.
+        self.stall_time = 0.0 #Spent switching training chunks
+        self.evaluation_stall_time = 0.0 #Spent switching validation and test chunks
+        self.permutation = None #Order of all training rows this epoch. None keeps the rows in their chunks.
+        self.evaluation = {} #Validation and test sets, moved to the GPU a chunk at a time
 
 
     @abstractmethod
@@ -46,7 +58,19 @@ class AbstractDataset(object):
         """Loading and transforming logic for dataset"""
         return
 
+    def prepare(self, dataset_path, params):
+        '''
+        Samples and stores the examples load reads from the disk caches, without loading the dataset. Runs started at
+        the same time then read the cache, instead of all sampling the same examples. Pre-generated datasets have
+        nothing to prepare.
+        '''
+        return
+
     def destroy(self):
+        if self.prefetcher:
+            self.prefetcher.invalidate()
+        for evaluation in self.evaluation.values():
+            evaluation.invalidate()
         #Remove contents from GPU
         #TODO: symbolic cast operation, makes set_value not possible.
         for key in self.set:
@@ -71,26 +95,29 @@ class AbstractDataset(object):
 
 
     def _chunkify(self, dataset, nr_of_chunks, batch_size):
-        #Round items per chunk down until there is an exact number of minibatches. Multiple of batch_size
-        items_per_chunk = len(dataset[0])/ nr_of_chunks
-        if(items_per_chunk < batch_size):
+        #Minibatches are spread evenly over the chunks, and the last chunk gets the rest. Only full minibatches are
+        #trained, so the last len(dataset[0]) % batch_size examples of the last chunk are left out of every epoch. If
+        #the training set is shuffled, other examples end up there every epoch.
+        nr_batches = int(math.ceil(len(dataset[0]) / float(batch_size)))
+        if(nr_batches < nr_of_chunks):
             print_error('Chunk limit in config set to small, or batch size to large. \n'
                         'Each chunk must include at least one batch.')
             raise Exception('Fix chunk_size and batch_size')
-        temp = int(items_per_chunk / batch_size)
-        items_per_chunk = batch_size * temp
+        items_per_chunk = batch_size * int(math.ceil(nr_batches / float(nr_of_chunks)))
         data, labels = dataset
-        #TODO:do floatX operation twice.
-        chunks = [[AbstractDataset._floatX(data[x:x+items_per_chunk]), AbstractDataset._floatX(labels[x:x+items_per_chunk])]
-                         for x in xrange(0, len(dataset[0]), items_per_chunk)]
+        #Chunks are slices, and are only decoded and cast to floatX when moved to the GPU. For memory-mapped
+        #examples, only the active chunk is read into memory.
+        chunks = [[data[x:x+items_per_chunk], labels[x:x+items_per_chunk]]
+                  for x in xrange(0, len(dataset[0]), items_per_chunk)]
 
-        #If the last chunk is less than batch size, it is cut. No reason for an unnecessary swap.
+        #A last chunk without a full minibatch is added to the one before, instead of being switched in on its own,
+        #where none of its examples would be trained. dataset_sizes keeps room for it.
         last_chunk_size = len(chunks[-1][0])
-        #TODO: Quick fix
-        if(last_chunk_size < batch_size*15):
+        if(len(chunks) > 1 and last_chunk_size < batch_size):
             chunks.pop(-1)
-            print('---- Removed last chunk. '
-                  '{} elements not enough for at least one minibatch of {}'.format(last_chunk_size, batch_size))
+            start = len(dataset[0]) - items_per_chunk - last_chunk_size
+            chunks[-1] = [data[start:], labels[start:]]
+            print('---- Last {} elements added to the chunk before'.format(last_chunk_size))
         return chunks
 
 
@@ -111,18 +138,210 @@ class AbstractDataset(object):
         nr_of_chunks times per epoch.
         '''
         #print('---- Changing active chunk') #This works very well so no need to print it all the time
-        new_chunk_x, new_chunk_y = self.all_training[idx]
-        self.active[0].set_value(new_chunk_x)
-        self.active[1].set_value(new_chunk_y)
+        end_of_epoch = self.permutation is not None and idx == len(self.all_training) - 1
+        if idx == self.active_idx and not end_of_epoch:
+            #With a single chunk, it stays on the GPU between epochs, unless the rows are shuffled. Chunk 0 is already
+            #active when training starts, and the next chunk still has to be prepared.
+            self._prefetch_next(idx)
+            return
+        if idx != self.active_idx:
+            start = timeit.default_timer()
+            if self.prefetcher:
+                new_chunk_x, new_chunk_y = self.prefetcher.get(idx)
+            else:
+                new_chunk_x, new_chunk_y = self._load_chunk(idx)
+            self.active[0].set_value(new_chunk_x, borrow=True)
+            self.active[1].set_value(new_chunk_y, borrow=True)
+            self.active_idx = idx
+            self.stall_time += timeit.default_timer() - start
+
+        if end_of_epoch:
+            #Last chunk of the epoch is on the GPU, so the rows can be reordered for the next epoch.
+            self.shuffle_training_set()
+            self.active_idx = None
+
+        self._prefetch_next(idx)
+
+
+    def _prefetch_next(self, idx):
+        #The next chunk is prepared while this one is used for training.
+        if self.prefetcher and (len(self.all_training) > 1 or self.permutation is not None):
+            self.prefetcher.prefetch((idx + 1) % len(self.all_training))
+
+
+    def shuffle_training_set(self):
+        '''
+        Draws a new order of all training rows. The examples stay where they are, in the chunks they were sampled
+        into, and each chunk moved to the GPU is gathered from the rows at its positions in the order. Examples are
+        therefore mixed across chunks every epoch, at the cost of a single gather per chunk switch. A sharded training
+        set is shuffled by shard instead, since a chunk gathered from every shard would decompress the entire set. The
+        shards are put in random order, and the rows of each chunk are shuffled.
+        '''
+        if self.prefetcher:
+            self.prefetcher.invalidate()
+        nr_rows = sum(len(c[0]) for c in self.all_training)
+        if self._is_sharded_training_set():
+            permutation = self.all_training[0][0].sharded_set.get_shuffled_rows()
+            start = 0
+            for chunk in self.all_training:
+                np.random.shuffle(permutation[start: start + len(chunk[0])])
+                start += len(chunk[0])
+            self.permutation = permutation
+        else:
+            self.permutation = np.random.permutation(nr_rows)
+
+
+    def _is_sharded_training_set(self):
+        #Training chunks that are views of an entire sharded set, so row numbers in the set are training row numbers.
+        data = self.all_training[0][0]
+        return isinstance(data, ShardedArray) and data.start == 0 and \
+            len(data.sharded_set) == sum(len(c[0]) for c in self.all_training)
+
+
+    def _get_chunk(self, idx):
+        '''
+        Examples of training chunk idx, in the order drawn by shuffle_training_set if the training set is shuffled.
+        Rows are gathered chunk by chunk and in increasing order, so memory-mapped chunks are read sequentially.
+        '''
+        if self.permutation is None:
+            return self.all_training[idx]
+        chunk_sizes = np.array([len(chunk[0]) for chunk in self.all_training])
+        chunk_starts = np.cumsum(chunk_sizes) - chunk_sizes
+        rows = self.permutation[chunk_starts[idx]: chunk_starts[idx] + chunk_sizes[idx]]
+        if self._is_sharded_training_set():
+            #The chunks are views of the same set, and reading the rows at once reads every shard once.
+            order = np.argsort(rows, kind='mergesort')
+            data, labels = self.all_training[0]
+            gathered = data.take(rows[order]), labels.take(rows[order])
+            for array in gathered:
+                array[order] = array.copy()
+            return gathered
+        source_chunks = np.searchsorted(chunk_starts, rows, side='right') - 1
+        source_rows = rows - chunk_starts[source_chunks]
+
+        data, labels = self.all_training[0]
+        data = np.empty((len(rows),) + data.shape[1:], dtype=data.dtype)
+        labels = np.empty((len(rows),) + labels.shape[1:], dtype=labels.dtype)
+        for c in np.unique(source_chunks):
+            positions = np.flatnonzero(source_chunks == c)
+            positions = positions[np.argsort(source_rows[positions], kind='mergesort')]
+            data[positions] = self.all_training[c][0][source_rows[positions]]
+            labels[positions] = self.all_training[c][1][source_rows[positions]]
+        return data, labels
+
+
+    def _load_chunk(self, idx):
+        return self._prepare_chunk(self._get_chunk(idx))
+
+
+    def enable_prefetch(self):
+        self.prefetcher = ChunkPrefetcher(self._load_chunk)
+
+
+    def invalidate_chunks(self):
+        '''
+        Must be called before the training chunks are changed. Waits for any chunk being prepared in the background and
+        discards it, and makes sure the active chunk is switched in again.
+        '''
+        if self.prefetcher:
+            self.prefetcher.invalidate()
+        self.active_idx = None
+
+
+    def reset_training_set(self):
+        '''
+        Undoes the changes training made to the training set, so another run can start from the loaded state. Only
+        curriculum learning changes it, by mixing in later stages.
+        '''
+        return
+
+
+    def set_label_noise(self, enable_label_noise, label_noise):
+        '''
+        Replaces the training labels by the labels of another label noise level. The examples and the shared variables
+        are kept, so functions compiled for them can be used again. Loaders that cannot change the labels in place
+        return False, and the dataset has to be loaded again.
+        '''
+        return False
+
+
+    def _replace_training_labels(self, labels):
+        #Labels for all training rows, sliced at the chunk boundaries.
+        self.invalidate_chunks()
+        start = 0
+        for chunk in self.all_training:
+            chunk[1] = labels[start: start + len(chunk[0])]
+            start += len(chunk[0])
+
+
+    def reset_stall_time(self, evaluation=False):
+        '''
+        Seconds training has waited for chunk switches since the last reset. With evaluation, the seconds validation and
+        test have waited for chunk switches instead.
+        '''
+        if evaluation:
+            stall_time = self.evaluation_stall_time
+            self.evaluation_stall_time = 0.0
+            return stall_time
+        stall_time = self.stall_time
+        self.stall_time = 0.0
+        return stall_time
+
+
+    def create_evaluation_sets(self, valid, test, chunk_size, prefetch=False):
+        '''
+        Validation and test sets in chunks of chunk_size examples. Only the active chunk of each set is on the GPU.
+        '''
+        for set_name, data_xy in [('validation', valid), ('test', test)]:
+            evaluation = EvaluationSet(self, set_name, data_xy, chunk_size, prefetch=prefetch)
+            self.evaluation[set_name] = evaluation
+            self.set[set_name] = evaluation.active[0], T.cast(evaluation.active[1], 'int32')
+
+
+    def get_shared_variables(self):
+        #Shared variables of the active training, validation and test chunks, in a fixed order.
+        shared = list(self.active)
+        for set_name in ['validation', 'test']:
+            shared += list(self.evaluation[set_name].active)
+        return shared
+
+
+    def switch_active_evaluation_set(self, set_name, idx):
+        self.evaluation[set_name].switch(idx)
+
+
+    def get_evaluation_chunk_number(self, set_name):
+        return len(self.evaluation[set_name].chunks)
+
+
+    def get_evaluation_elements(self, set_name, idx):
+        return len(self.evaluation[set_name].chunks[idx][0])
+
+
+    def _prepare_chunk(self, data_xy, set_name='train'):
+        '''
+        Examples in the format used on the GPU. Compact uint8 examples are rescaled, and contrast normalized if
+        preprocessing is enabled. Other examples are only cast to floatX. Memory-mapped and sharded examples are read.
+        '''
+        data_x, data_y = data_xy
+        if isinstance(data_x, ShardedArray):
+            data_x, data_y = np.array(data_x), np.array(data_y)
+        if data_x.dtype == np.uint8:
+            data_x = util.decode_data(data_x, self.std, self.preprocessing, theano.config.floatX)
+            data_y = util.decode_labels(data_y, theano.config.floatX)
+        elif isinstance(data_x, np.memmap):
+            #Read from disk here, which is on the prefetch thread if enabled.
+            return np.array(data_x, dtype=theano.config.floatX), np.array(data_y, dtype=theano.config.floatX)
+        return AbstractDataset._floatX(data_x), AbstractDataset._floatX(data_y)
 
 
     def shared_dataset(self, data_xy, borrow=True, cast_to_int=True):
         #Stored in theano shared variable to allow Theano to copy it into GPU memory
-        data_x, data_y = data_xy
+        data_x, data_y = self._prepare_chunk(data_xy)
         print(data_x.shape)
         print(data_y.shape)
-        shared_x = theano.shared(AbstractDataset._floatX(data_x), borrow=borrow)
-        shared_y = theano.shared(AbstractDataset._floatX(data_y), borrow=borrow)
+        shared_x = theano.shared(data_x, borrow=borrow)
+        shared_y = theano.shared(data_y, borrow=borrow)
         self.all_shared_hooks.append(shared_y)
         if cast_to_int:
             print("---- Casted to int")
@@ -156,12 +375,18 @@ class AbstractDataset(object):
             raise Exception('Decrease batch_size or increase samples_per_image')
 
     @staticmethod
-    def dataset_sizes(train, valid, test, chunks):
-        mb = 1000000.0
-        train_size = sum(data.nbytes for data in train) / mb
-        valid_size = sum(data.nbytes for data in valid) / mb
-        test_size = sum(data.nbytes for data in test) / mb
-        nr_of_chunks = math.ceil(train_size/chunks)
+    def dataset_sizes(train, valid, test, chunks, batch_size=1):
+        #Sizes on the GPU, compact uint8 examples are decoded to floatX before they are moved there.
+        mb = 1000000.0 / np.dtype(theano.config.floatX).itemsize
+        train_size = sum(data.size for data in train) / mb
+        valid_size = sum(data.size for data in valid) / mb
+        test_size = sum(data.size for data in test) / mb
+        if chunks == 'auto':
+            chunks = AbstractDataset.plan_chunk_size(train_size, [valid_size, test_size])
+        #_chunkify rounds chunks up to whole minibatches, and adds a tail shorter than a minibatch to the last chunk.
+        #Room for two minibatches is kept, so no chunk is larger than the chunk size.
+        batch_mb = train_size / max(1, len(train[0])) * batch_size
+        nr_of_chunks = math.ceil(train_size / max(chunks - 2 * batch_mb, batch_mb))
 
         print('---- Minimum number of training chunks: {}'.format(nr_of_chunks))
         print('---- Dataset at least:')
@@ -170,6 +395,79 @@ class AbstractDataset(object):
         print('---- Testing: \t {}mb'.format(test_size))
         return nr_of_chunks
 
+    @staticmethod
+    def plan_chunk_size(train_size, eval_sizes):
+        '''
+        Largest training chunk in mb that fits in memory. On the device, the chunk shares the budget with the validation
+        and test sets. If evaluation is streamed, sets larger than the chunk are moved to the GPU in chunks of the same
+        size. On the host, the chunk in the shared variables and the chunk being prefetched must fit in a fraction of
+        the available memory. The whole training set is used as a single chunk if it fits, so there are no chunk
+        switches.
+        '''
+        device_memory = AbstractDataset.get_device_memory()
+        host_memory = AbstractDataset.get_host_memory()
+        limit = train_size
+        streamed = 0
+        print('---- Memory plan:')
+        if device_memory is not None:
+            limit = min(limit, device_memory - sum(eval_sizes))
+            if dataset_params.stream_evaluation and limit < max(eval_sizes):
+                #The k smallest sets stay on the device in full, and the others share the rest with training chunks.
+                eval_sizes = sorted(eval_sizes)
+                for k in reversed(range(len(eval_sizes))):
+                    streamed = len(eval_sizes) - k
+                    limit = min(train_size, (device_memory - sum(eval_sizes[:k])) / float(1 + streamed))
+                    if k == 0 or limit >= eval_sizes[k - 1]:
+                        break
+            print('---- Device: \t {}mb available, validation and test {}mb, {} of them streamed'.format(
+                device_memory, sum(eval_sizes), streamed))
+        if host_memory is not None:
+            copies = 2 if dataset_params.prefetch_chunks else 1
+            if dataset_params.stream_evaluation:
+                copies *= 1 + len(eval_sizes)
+            host_limit = host_memory * dataset_params.host_memory_fraction / copies
+            print('---- Host: \t {}mb available, {} chunk copies'.format(host_memory, copies))
+            limit = min(limit, host_limit)
+        if limit <= 0:
+            print_error('Validation and test sets leave no device memory for training chunks')
+            raise Exception('Increase device_memory or reduce the validation and test sets')
+        print('---- Chunk size: {}mb'.format(limit))
+        return limit
+
+
+    @staticmethod
+    def get_device_memory():
+        '''
+        Mb on the device for examples. The configured device_memory, or the free memory of the GPU. None if Theano
+        runs on the CPU, where the examples are kept in host memory.
+        '''
+        if dataset_params.device_memory is not None:
+            return dataset_params.device_memory
+        device = getattr(theano.config, 'device', 'cpu')
+        if device.startswith('gpu'):
+            from theano.sandbox.cuda import cuda_ndarray
+            free, total = cuda_ndarray.cuda_ndarray.mem_info()
+            return free / 1000000.0
+        if device.startswith('cuda'):
+            from theano.gpuarray.type import get_context
+            return get_context(None).free_gmem / 1000000.0
+        return None
+
+
+    @staticmethod
+    def get_host_memory():
+        #Available memory in mb, as estimated by the kernel. None if not on Linux.
+        if not os.path.isfile('/proc/meminfo'):
+            return None
+        with open('/proc/meminfo') as fp:
+            meminfo = dict(line.split(':', 1) for line in fp)
+        if 'MemAvailable' in meminfo:
+            available = int(meminfo['MemAvailable'].split()[0])
+        else:
+            available = sum(int(meminfo[key].split()[0]) for key in ['MemFree', 'Buffers', 'Cached'])
+        return available * 1024 / 1000000.0
+
+
     @staticmethod
     def dataset_shared_stats(image_shape, label_shape, chunks):
         print('')
@@ -184,6 +482,118 @@ class AbstractDataset(object):
         print('---- Last chunk size: {}'.format(elements_last_chunk))
 
 
+class ChunkPrefetcher(object):
+    '''
+    Prepares the next chunk on a background thread, while the current chunk is used for training or evaluation. Decoding
+    compact examples and rebuilding plan records then overlaps with training, and a chunk switch only has to upload the
+    prepared chunk. The prepared chunk and the chunk in the active shared variables are two host buffers used in turn,
+    so the buffer borrowed by the shared variables is never written while it is in use.
+    '''
+
+    def __init__(self, load):
+        self.load = load #Prepares the chunk of an index
+        self.thread = None
+        self.idx = None
+        self.result = None
+        self.error = None
+
+
+    def prefetch(self, idx):
+        if idx == self.idx:
+            #Already prepared, or being prepared.
+            return
+        self.invalidate()
+        self.idx = idx
+        self.thread = threading.Thread(target=self._prepare, args=(idx,))
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def get(self, idx):
+        '''
+        Prepared chunk idx. Waits for the background thread if it is still preparing it. A chunk that was not
+        prefetched is prepared right away.
+        '''
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+        if self.idx != idx or self.result is None:
+            self.result = self.load(idx)
+        result, self.result, self.idx = self.result, None, None
+        return result
+
+
+    def invalidate(self):
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.idx = None
+        self.result = None
+        self.error = None
+
+
+    def _prepare(self, idx):
+        try:
+            self.result = self.load(idx)
+        except Exception as e:
+            self.error = e
+
+
+class EvaluationSet(object):
+    '''
+    Validation or test set moved to the GPU a chunk at a time, like the training set, so its size is only limited by
+    where it is kept on the host. For memory-mapped sets that is the disk. A set that fits in a single chunk stays on
+    the GPU. The next chunk can be prepared in the background while a chunk is evaluated.
+    '''
+
+    def __init__(self, dataset, set_name, data_xy, chunk_size, prefetch=False):
+        self.dataset = dataset
+        self.set_name = set_name
+        data, labels = data_xy
+        chunk_size = max(1, chunk_size)
+        self.chunks = [(data[x:x+chunk_size], labels[x:x+chunk_size]) for x in xrange(0, len(data), chunk_size)]
+        print('---- {} set: {} chunks of {} elements'.format(set_name, len(self.chunks), len(self.chunks[0][0])))
+
+        data_x, data_y = self._load_chunk(0)
+        self.active = theano.shared(data_x, borrow=True), theano.shared(data_y, borrow=True)
+        dataset.all_shared_hooks.append(self.active[1])
+        self.active_idx = 0
+        self.prefetcher = None
+        if prefetch and len(self.chunks) > 1:
+            self.prefetcher = ChunkPrefetcher(self._load_chunk)
+            self.prefetcher.prefetch(1)
+
+
+    def switch(self, idx):
+        if idx == self.active_idx:
+            return
+        start = timeit.default_timer()
+        if self.prefetcher:
+            new_chunk_x, new_chunk_y = self.prefetcher.get(idx)
+        else:
+            new_chunk_x, new_chunk_y = self._load_chunk(idx)
+        self.active[0].set_value(new_chunk_x, borrow=True)
+        self.active[1].set_value(new_chunk_y, borrow=True)
+        self.active_idx = idx
+        self.dataset.evaluation_stall_time += timeit.default_timer() - start
+
+        #After the last chunk, the first one is prepared for the next evaluation.
+        if self.prefetcher:
+            self.prefetcher.prefetch((idx + 1) % len(self.chunks))
+
+
+    def invalidate(self):
+        if self.prefetcher:
+            self.prefetcher.invalidate()
+
+
+    def _load_chunk(self, idx):
+        return self.dataset._prepare_chunk(self.chunks[idx], self.set_name)
+
+
 class AerialCurriculumDataset(AbstractDataset):
     '''
     Data loader for pre-generated dataset. IE, curriculum learning and datasets too big to fit in main memory.
@@ -191,18 +601,42 @@ class AerialCurriculumDataset(AbstractDataset):
     control the behavior of the switch.
     '''
 
-    def load_set(self, path, set, stage=None):
+    def load_set(self, path, set, stage=None, mmap_mode='r'):
+        '''
+        Examples are memory-mapped, so sets and stages larger than main memory can be used. Pages are read when a
+        chunk is moved to the GPU, or when examples are mixed in from a stage. Sharded sets are lazy views, and only the
+        shards of a chunk are read and decompressed, in parallel.
+        '''
         base_path = ""
         if stage != None:
             base_path = os.path.join(path, set, stage)
         else:
             base_path = os.path.join(path, set)
 
-        labels = np.load(os.path.join(base_path, "labels", "examples.npy"))
-        data = np.load(os.path.join(base_path, "data", "examples.npy"))
+        if ShardedSet.is_sharded(base_path):
+            sharded_set = ShardedSet(base_path)
+            return ShardedArray(sharded_set, 'data'), ShardedArray(sharded_set, 'labels')
+        labels = np.load(os.path.join(base_path, "labels", "examples.npy"), mmap_mode=mmap_mode)
+        data = np.load(os.path.join(base_path, "data", "examples.npy"), mmap_mode=mmap_mode)
         return data, labels
 
+    def reset_training_set(self):
+        #The first stage again, sliced at the chunk boundaries, without the stages mixed in.
+        if self.stage == 0:
+            return
+        self.stage = 0
+        data, labels = self.load_set(self.dataset_path, "train", stage="stage0", mmap_mode='c')
+        self.invalidate_chunks()
+        start = 0
+        for chunk in self.all_training:
+            chunk[0], chunk[1] = data[start: start + len(chunk[0])], labels[start: start + len(chunk[0])]
+            start += len(chunk[0])
+        if self.permutation is not None:
+            self.shuffle_training_set()
+
+
     def mix_in_next_stage(self):
+        self.invalidate_chunks()
         self.stage += 1
         if self.nr_of_stages <= self.stage:
             #print("temporary looping through stages")
@@ -213,50 +647,73 @@ class AerialCurriculumDataset(AbstractDataset):
 
         current_stage = "stage{}".format(self.stage)
 
-        labels = np.load(os.path.join(self.stage_path, current_stage, "labels", "examples.npy"))
-        data = np.load(os.path.join(self.stage_path, current_stage, "data", "examples.npy"))
+        mix_fraction = dataset_params.mix_fraction
+        stage_path = os.path.join(self.stage_path, current_stage)
+        if ShardedSet.is_sharded(stage_path):
+            #Only enough random shards to mix in mix_fraction of the stage are read.
+            stage = ShardedSet(stage_path)
+            order = np.random.permutation(len(stage.shards))
+            counts = np.cumsum([stage.shards[i]['count'] for i in order])
+            nr_needed = int(round(len(stage) * mix_fraction))
+            nr_shards = min(np.searchsorted(counts, nr_needed) + 1, len(order))
+            data, labels = stage.load(sorted(order[:nr_shards]))
+            mix_fraction = nr_needed / float(max(1, data.shape[0]))
+        else:
+            data, labels = self.load_set(self.dataset_path, "train", stage=current_stage)
         print("---- Mixing in {} with {} examples".format(current_stage, data.shape[0]))
 
 
-        if not dataset_params.with_replacement:
-            elements = data.shape[0]
-            shuffle_counter = 0
-            shuffled_index = range(elements)
-            random.shuffle(shuffled_index)
-            #print (len(shuffled_index))
-            for c in range(len(self.all_training)):
-                nr_chunk_examples =  self.all_training[c][0].shape[0]
-                for x in range(nr_chunk_examples    ):
-                    if shuffle_counter < elements:
-                        i = shuffled_index.pop()
-                        #print(c, x, i)
-                        self.all_training[c][0][x] = data[i]
-                        self.all_training[c][1][x] = labels[i]
-                    else:
-                        break
-                    shuffle_counter += 1
-        else:
-            nr_chunks = len(self.all_training)
-            for i in range(data.shape[0]):
-                c = random.randint(0,nr_chunks-1)
-                nr_chunk_examples =  self.all_training[c][0].shape[0]
-                x = random.randint(0, nr_chunk_examples-1)
-                self.all_training[c][0][x] = data[i]
-                self.all_training[c][1][x] = labels[i]
+        self._mix(data, labels, dataset_params.with_replacement, mix_fraction)
+
 
+    def _mix(self, data, labels, with_replacement, mix_fraction):
+        '''
+        Scatters a random mix_fraction of the examples into the training chunks. The target rows for all examples are
+        drawn at once. With replacement, every example replaces a random row, and an example can be replaced by a later
+        one. Without replacement, the examples replace distinct random rows, and if the stage has as many examples as
+        the training set, the entire training set is replaced.
+        '''
+        chunk_sizes = np.array([len(chunk[0]) for chunk in self.all_training])
+        nr_training = chunk_sizes.sum()
+        nr_mixed = int(round(data.shape[0] * mix_fraction))
+        if with_replacement:
+            sources = np.random.permutation(data.shape[0])[:nr_mixed]
+            target_chunks = np.random.randint(0, len(chunk_sizes), nr_mixed)
+            target_rows = (np.random.random_sample(nr_mixed) * chunk_sizes[target_chunks]).astype(np.intp)
+        else:
+            nr_mixed = min(nr_mixed, nr_training)
+            sources = np.random.permutation(data.shape[0])[:nr_mixed]
+            targets = np.random.permutation(nr_training)[:nr_mixed]
+            chunk_starts = np.cumsum(chunk_sizes) - chunk_sizes
+            target_chunks = np.searchsorted(chunk_starts, targets, side='right') - 1
+            target_rows = targets - chunk_starts[target_chunks]
+
+        for c in range(len(self.all_training)):
+            in_chunk = target_chunks == c
+            #Sorted sources read memory-mapped stages sequentially.
+            order = np.argsort(sources[in_chunk], kind='mergesort')
+            chunk_sources = sources[in_chunk][order]
+            chunk_rows = target_rows[in_chunk][order]
+            self.all_training[c][0][chunk_rows] = data[chunk_sources]
+            self.all_training[c][1][chunk_rows] = labels[chunk_sources]
+        print("---- Mixed {} examples into {} training examples".format(nr_mixed, nr_training))
 
 
     def load(self, dataset_path, params, batch_size=1):
         print_section('Loading aerial curriculum dataset')
         chunks = params.chunk_size
         self.std = params.dataset_std #Need for debug
+        #Only used to decode compact uint8 examples. Float examples are already normalized.
+        self.preprocessing = params.use_preprocessing
 
         #For later stage loading
+        self.dataset_path = dataset_path
         self.stage = 0
         self.stage_path = os.path.join(dataset_path, "train")
         self.nr_of_stages = len(os.listdir(os.path.join(dataset_path, "train")))
 
-        train = self.load_set(dataset_path, "train", stage="stage{}".format(self.stage))
+        #Copy on write, since later stages are mixed into the training chunks. Only changed pages use memory.
+        train = self.load_set(dataset_path, "train", stage="stage{}".format(self.stage), mmap_mode='c')
         valid = self.load_set(dataset_path, "valid")
         test = self.load_set(dataset_path, "test")
 
@@ -269,22 +726,95 @@ class AerialCurriculumDataset(AbstractDataset):
 
         self.set_nr_examples(train, valid, test)
 
-        nr_of_chunks = AerialCurriculumDataset.dataset_sizes(train, valid, test, chunks)
+        nr_of_chunks = self.dataset_sizes(train, valid, test, chunks, batch_size)
 
         training_chunks = self._chunkify(train, nr_of_chunks, batch_size)
 
         AerialCurriculumDataset.dataset_chunk_stats(len(training_chunks), len(training_chunks[0][0]), len(training_chunks[-1][0]))
 
-        self.active = self.shared_dataset(training_chunks[0], cast_to_int=False)
+        #Not stored on the GPU, unlike the shared variables defined below.
+        self.all_training = training_chunks
+        if params.shuffle_training:
+            self.shuffle_training_set()
+
+        self.active = self.shared_dataset(self._get_chunk(0), cast_to_int=False)
         self.set['train'] = self.active[0], T.cast(self.active[1], 'int32')
-        self.set['validation'] = self.shared_dataset(valid, cast_to_int=True )
-        self.set['test'] = self.shared_dataset(test, cast_to_int=True)
+        #Streamed in chunks the size of the training chunks, unless the sets are moved to the GPU in full.
+        eval_chunk_size = len(training_chunks[0][0]) if params.stream_evaluation else max(len(valid[0]), len(test[0]))
+        self.create_evaluation_sets(valid, test, eval_chunk_size, prefetch=params.prefetch_chunks)
 
-        #Not stored on the GPU, unlike the shared variables defined above.
-        self.all_training = training_chunks
+        if params.prefetch_chunks:
+            self.enable_prefetch()
         return True
 
 
+class AerialPlanDataset(AerialCurriculumDataset):
+    '''
+    Data loader for pre-generated datasets stored as sampling plans. Only the records are kept in memory, and the
+    examples of a training chunk are rebuilt from the tiles of the source dataset when the chunk is moved to the GPU.
+    Validation and test examples are rebuilt once. Stage switching and mixing works on the records.
+    '''
+
+    plan_set_names = {'validation': 'valid'}
+
+    def load(self, dataset_path, params, batch_size=1):
+        self.plan = SamplingPlan(dataset_path)
+        self.rebuild_lock = threading.Lock()
+        self.dim = self.plan.manifest['dim']
+        #The tiles can be at another location than where the plan was sampled.
+        source = params.plan_tile_path or self.plan.manifest['source']
+        print('---- Rebuilding examples from {}'.format(source))
+
+        self.creator = Creator(source,
+                               dim=self.dim,
+                               preproccessing=params.use_preprocessing,
+                               std=params.dataset_std,
+                               compact=True,
+                               cache_size=params.tile_cache_size,
+                               noise_cache=params.label_noise_cache)
+        self.creator.load_dataset()
+        self.datasets = {'train': self.creator.train, 'valid': self.creator.valid, 'test': self.creator.test}
+        for set_name in self.datasets:
+            self.plan.check_dataset(set_name, self.datasets[set_name])
+
+        return AerialCurriculumDataset.load(self, dataset_path, params, batch_size=batch_size)
+
+
+    def load_set(self, path, set, stage=None, mmap_mode='r'):
+        records = self.plan.load_records(set, stage)
+        if set != 'train' and not dataset_params.stream_evaluation:
+            return self._rebuild(set, records)
+        #The records stand in for both data and labels, so mixing replaces a record once for each.
+        return records, records
+
+
+    def _prepare_chunk(self, data_xy, set_name='train'):
+        if data_xy[0].dtype.fields:
+            data_xy = self._rebuild(self.plan_set_names.get(set_name, set_name), data_xy[0])
+        return AerialCurriculumDataset._prepare_chunk(self, data_xy)
+
+
+    def _rebuild(self, set_name, records):
+        #Training and evaluation chunks can be prepared at the same time, and the tile cache is not thread safe.
+        with self.rebuild_lock:
+            return self.creator.extract_records(self.datasets[set_name], records, self.plan.has_rotation(set_name),
+                                                label_noise=self.plan.manifest['label_noise'])
+
+
+    def dataset_sizes(self, train, valid, test, chunks, batch_size=1):
+        #Size of the rebuilt examples, without allocating them.
+        return AerialCurriculumDataset.dataset_sizes(self._get_rebuilt_size(train), self._get_rebuilt_size(valid),
+                                                     self._get_rebuilt_size(test), chunks, batch_size)
+
+
+    def _get_rebuilt_size(self, data_xy):
+        if not data_xy[0].dtype.fields:
+            return data_xy
+        nr_examples = len(data_xy[0])
+        return (np.broadcast_to(np.uint8(0), (nr_examples, self.dim[0]*self.dim[0]*3)),
+                np.broadcast_to(np.uint8(0), (nr_examples, self.dim[1]*self.dim[1])))
+
+
 class AerialDataset(AbstractDataset):
     '''
     Dataset loader. This class does not load a pre-generated patch dataset. Instead, it creates patch datasets from
@@ -295,24 +825,31 @@ class AerialDataset(AbstractDataset):
         print_section('Creating aerial image dataset')
 
         self.std = params.dataset_std
+        self.preprocessing = params.use_preprocessing
         chunks = params.chunk_size
 
-        #TODO: ensure that the dataset is as expected.
-        creator = Creator(dataset_path,
-                          dim=(params.input_dim, params.output_dim),
-                          rotation=params.use_rotation,
-                          preproccessing=params.use_preprocessing,
-                          std=self.std,
-                          only_mixed=params.only_mixed_labels,
-                          reduce_testing=params.reduce_testing,
-                          reduce_training=params.reduce_training,
-                          reduce_validation=params.reduce_validation)
-        train, valid, test = creator.dynamically_create(
-            params.samples_per_image,
-            enable_label_noise=params.use_label_noise,
-            label_noise=params.label_noise,
-            only_mixed=params.only_mixed_labels
-        )
+        creator = AerialDataset._create_creator(dataset_path, params)
+        #Validation and test sets shared with the precision and recall measurement, and with other runs.
+        self.cache = None
+        frozen = None
+        if params.evaluation_sets:
+            frozen = FrozenEvaluationSets.create(params.evaluation_sets, dataset_path, params)
+
+        if params.dataset_cache:
+            #Sampled once per dataset and sampling parameters, and memory-mapped by later runs.
+            self.cache = DatasetCache(params.dataset_cache, creator, params.samples_per_image,
+                                      evaluation=frozen is None)
+            train, valid, test = self.cache.get(enable_label_noise=params.use_label_noise, label_noise=params.label_noise)
+        else:
+            train, valid, test = creator.dynamically_create(
+                params.samples_per_image,
+                enable_label_noise=params.use_label_noise,
+                label_noise=params.label_noise,
+                only_mixed=params.only_mixed_labels,
+                evaluation=frozen is None
+            )
+        if frozen:
+            valid, test = frozen.get('valid'), frozen.get('test')
 
         #Testing dataset size requirements
         AerialDataset.dataset_check('train', train, batch_size)
@@ -323,20 +860,61 @@ class AerialDataset(AbstractDataset):
 
         self.set_nr_examples(train, valid, test)
 
-        nr_of_chunks = AerialDataset.dataset_sizes(train, valid, test, chunks)
+        nr_of_chunks = AerialDataset.dataset_sizes(train, valid, test, chunks, batch_size)
 
         training_chunks = self._chunkify(train, nr_of_chunks, batch_size)
 
         AerialDataset.dataset_chunk_stats(len(training_chunks), len(training_chunks[0][0]), len(training_chunks[-1][0]))
 
-        self.active = self.shared_dataset(training_chunks[0], cast_to_int=False)
+        #Not stored on the GPU, unlike the shared variables defined below.
+        self.all_training = training_chunks
+        if params.shuffle_training:
+            self.shuffle_training_set()
+
+        self.active = self.shared_dataset(self._get_chunk(0), cast_to_int=False)
         self.set['train'] = self.active[0], T.cast(self.active[1], 'int32')
-        self.set['validation'] = self.shared_dataset(valid, cast_to_int=True )
-        self.set['test'] = self.shared_dataset(test, cast_to_int=True)
+        #Streamed in chunks the size of the training chunks, unless the sets are moved to the GPU in full.
+        eval_chunk_size = len(training_chunks[0][0]) if params.stream_evaluation else max(len(valid[0]), len(test[0]))
+        self.create_evaluation_sets(valid, test, eval_chunk_size, prefetch=params.prefetch_chunks)
 
-        #Not stored on the GPU, unlike the shared variables defined above.
-        self.all_training = training_chunks
+        if params.prefetch_chunks:
+            self.enable_prefetch()
         return True
 
 
+    def set_label_noise(self, enable_label_noise, label_noise):
+        #Cached datasets keep the noisy labels of each noise level as a layer over the same examples.
+        if self.cache is None:
+            return False
+        train = self.cache.get(enable_label_noise=enable_label_noise, label_noise=label_noise)[0]
+        self._replace_training_labels(train[1])
+        return True
+
 
+    def prepare(self, dataset_path, params):
+        if params.evaluation_sets:
+            FrozenEvaluationSets.create(params.evaluation_sets, dataset_path, params).get('valid')
+        if params.dataset_cache:
+            cache = DatasetCache(params.dataset_cache, AerialDataset._create_creator(dataset_path, params),
+                                 params.samples_per_image, evaluation=not params.evaluation_sets)
+            cache.get(enable_label_noise=params.use_label_noise, label_noise=params.label_noise)
+
+
+    @staticmethod
+    def _create_creator(dataset_path, params):
+        #TODO: ensure that the dataset is as expected.
+        return Creator(dataset_path,
+                       dim=(params.input_dim, params.output_dim),
+                       rotation=params.use_rotation,
+                       preproccessing=params.use_preprocessing,
+                       std=params.dataset_std,
+                       only_mixed=params.only_mixed_labels,
+                       reduce_testing=params.reduce_testing,
+                       reduce_training=params.reduce_training,
+                       reduce_validation=params.reduce_validation,
+                       batched=params.use_batched_sampling,
+                       workers=params.sampling_workers,
+                       seed=params.sampling_seed,
+                       cache_size=params.tile_cache_size,
+                       compact=params.compact_storage,
+                       noise_cache=params.label_noise_cache)
@@ -3,13 +3,13 @@
 import numpy as np
 import theano
 import theano.tensor as T
-from util import debug_input_data, show_debug_sample
+from util import debug_input_data, show_debug_sample, PhaseTimer
 from printing import print_section, print_test, print_valid, print_training
 import random, sys, timeit
 from sdg import Backpropagation
 import interface.server
-from config import visual_params
-from wrapper import create_theano_func, create_profiler_func
+from config import visual_params, filename_params
+from wrapper import create_theano_func, create_profiler_func, FunctionCache
 from storage import ParamStorage
 
 class Evaluator(object):
@@ -26,18 +26,42 @@ class Evaluator(object):
         self.params = params
         self.report = {}
         self.events = []
+        self.epochs = [] #Timing and throughput of each epoch
+        self.path = path
+        self.train_model = None
 
         if(visual_params.gui_enabled):
             interface.server.start_new_job(path=path)
 
 
-    def run(self, epochs=10, verbose=False, init=None):
+    def run(self, epochs=10, verbose=False, init=None, checkpoint_path=None):
+        '''
+        Trains the model. Every 20 epochs the params are stored at checkpoint_path, with the epoch appended to the
+        name. Concurrent runs need a path each. The network save name in the config by default.
+        '''
         batch_size = self.params.batch_size
         self.nr_train_batches = self.data.get_total_number_of_batches(batch_size)
-        self.nr_valid_batches = self._get_number_of_batches('validation', batch_size)
-        self.nr_test_batches = self._get_number_of_batches('test', batch_size)
-        self._build(batch_size, init)
-        self._train(batch_size, epochs)
+        #A built evaluator is trained again with the functions it has compiled. See reset.
+        if self.train_model is None:
+            self._build(batch_size, init)
+        self._train(batch_size, epochs, checkpoint_path)
+
+
+    def reset(self):
+        '''
+        Prepares a built evaluator for another run. The weights are set back to the values the model was built with,
+        the optimizer state is cleared and the results of the last run are removed. The compiled functions are kept.
+        '''
+        for param, value in zip(self.model.params, self.initial_params):
+            param.set_value(value)
+        for state in self.optimizer_state:
+            state.set_value(np.zeros_like(state.get_value(borrow=True)))
+        self.report = {}
+        self.events = []
+        self.epochs = []
+
+        if(visual_params.gui_enabled):
+            interface.server.start_new_job(path=self.path)
 
 
     def _build(self, batch_size, init):
@@ -53,27 +77,57 @@ class Evaluator(object):
         mix_factor = T.scalar('factor', dtype=theano.config.floatX)
 
         self.model.build(x, drop, batch_size, init_params=init)
-        errors = self.model.get_output_layer().errors(y)
-
-        self.test_model = create_theano_func('test', self.data, x, y, drop, [index], errors, batch_size)
-        self.validate_model = create_theano_func('validation', self.data, x, y, drop, [index], errors, batch_size)
-        self.get_training_loss = create_theano_func(
-            'train', self.data, x, y, drop, [index], errors, batch_size, prefix="_loss"
-        )
-
-        cost = self.model.get_cost(y, mix_factor) + (self.params.l2_reg * self.model.getL2())
         opt = Backpropagation.create(self.model.params)
-        grads = T.grad(cost, self.model.params)
-        updates = opt.updates(self.model.params, grads, learning_rate, self.params.momentum)
-
-        self.train_model = create_theano_func(
-            'train', self.data, x, y, drop, [index, learning_rate, mix_factor], cost, batch_size,
-            updates=updates, dropping=True
-        )
-
-        self.tester = create_profiler_func(
-            self.data, x, y, drop, [index, mix_factor], self.model.get_output_layer(), cost, batch_size
-        )
+        self.initial_params = [p.get_value() for p in self.model.params]
+        self.optimizer_state = Backpropagation.get_state(opt)
+        #Compiled functions from earlier runs are bound to these, in this order.
+        self.shared = self.model.params + self.optimizer_state + self.data.get_shared_variables()
+
+        def compile():
+            errors = self.model.get_output_layer().errors(y)
+            functions = {}
+            functions['test'] = create_theano_func('test', self.data, x, y, drop, [index], errors, batch_size)
+            functions['validation'] = create_theano_func('validation', self.data, x, y, drop, [index], errors,
+                                                         batch_size)
+            functions['training_loss'] = create_theano_func(
+                'train', self.data, x, y, drop, [index], errors, batch_size, prefix="_loss"
+            )
+
+            cost = self.model.get_cost(y, mix_factor) + (self.params.l2_reg * self.model.getL2())
+            grads = T.grad(cost, self.model.params)
+            updates = opt.updates(self.model.params, grads, learning_rate, self.params.momentum)
+
+            functions['train'] = create_theano_func(
+                'train', self.data, x, y, drop, [index, learning_rate, mix_factor], cost, batch_size,
+                updates=updates, dropping=True
+            )
+            return functions
+
+        cache = FunctionCache(filename_params.function_cache, 'evaluator', self.model.model_config, self.params,
+                              batch_size)
+        functions = cache.get(self.shared, compile)
+        self.test_model = functions['test']
+        self.validate_model = functions['validation']
+        self.get_training_loss = functions['training_loss']
+        self.train_model = functions['train']
+
+        #Only used by GUI debug requests, so it is compiled when the first request arrives.
+        self.tester = None
+        self.symbols = (x, y, drop, index, mix_factor, batch_size)
+
+
+    def _get_tester(self):
+        if self.tester is None:
+            x, y, drop, index, mix_factor, batch_size = self.symbols
+            def compile():
+                cost = self.model.get_cost(y, mix_factor) + (self.params.l2_reg * self.model.getL2())
+                return {'tester': create_profiler_func(
+                    self.data, x, y, drop, [index, mix_factor], self.model.get_output_layer(), cost, batch_size
+                )}
+            cache = FunctionCache(filename_params.function_cache, 'tester', self.model.model_config, self.params,
+                                  batch_size)
+            self.tester = cache.get(self.shared, compile)['tester']
+        return self.tester
 
 
     def _debug(self, batch_size, nr_batches, factor):
@@ -88,7 +142,7 @@ class Evaluator(object):
         for test in range(number_of_tests):
             minibatch_index = random.randint(0, nr_batches-1)
             v = random.randint(0,batch_size-1)
-            output, y, cost, errs = self.tester(minibatch_index, factor)
+            output, y, cost, errs = self._get_tester()(minibatch_index, factor)
             predictions.append(output[v])
             labels.append(y[v])
             data.append(self.data.set['train'][0][(minibatch_index*batch_size) + v].eval())
@@ -97,7 +151,7 @@ class Evaluator(object):
 
 
     def _get_validation_score(self, batch_size, epoch, minibatch_index):
-        validation_loss = np.mean( [self.validate_model(i) for i in range(self.nr_valid_batches)] )
+        validation_loss = self._evaluate('validation', self.validate_model, batch_size)
         print_valid(epoch, minibatch_index + 1, self.nr_train_batches,  validation_loss)
         return validation_loss
 
@@ -107,19 +161,24 @@ class Evaluator(object):
         return training_loss
 
     def _get_test_score(self, batch_size):
-        test_score =  np.mean( [self.test_model(i) for i in range(self.nr_test_batches)] )
+        test_score = self._evaluate('test', self.test_model, batch_size)
         print_test(test_score)
         return test_score
 
 
-    def _get_number_of_batches(self, set_name, batch_size):
-        set_x, set_y = self.data.set[set_name]
-        nr_of_batches = set_x.get_value(borrow=True).shape[0]
-        nr_of_batches /= batch_size
-        return int(nr_of_batches)
+    def _evaluate(self, set_name, model, batch_size):
+        #Mean loss of all minibatches of a set, chunk by chunk.
+        losses = []
+        for chunk_index in range(self.data.get_evaluation_chunk_number(set_name)):
+            chunk_batches = self.data.get_evaluation_elements(set_name, chunk_index) / batch_size
+            if chunk_batches == 0:
+                continue
+            self.data.switch_active_evaluation_set(set_name, chunk_index)
+            losses.extend(model(i) for i in range(chunk_batches))
+        return np.mean(losses)
 
 
-    def _train(self, batch_size, max_epochs):
+    def _train(self, batch_size, max_epochs, checkpoint_path=None):
         print_section('Training model')
 
         patience = self.params.initial_patience # look as this many examples regardless
@@ -150,7 +209,12 @@ class Evaluator(object):
         test_score = 0.
         self.start_time = timeit.default_timer()
 
-        storage = ParamStorage()
+        storage = ParamStorage(path=checkpoint_path)
+        #chunk_stall is the part of chunk_switch the dataset spends getting the chunk and moving it to the GPU.
+        #evaluation_stall is the same for the chunks of the validation and test sets, and is part of those phases.
+        timer = PhaseTimer(['chunk_switch', 'chunk_stall', 'train', 'validation', 'test', 'evaluation_stall',
+                            'training_loss', 'gui', 'checkpoint', 'curriculum'])
+        self.timer = timer
 
         nr_chunks = self.data.get_chunk_number()
         epoch = 0
@@ -159,13 +223,14 @@ class Evaluator(object):
 
         #==== INITIAL PERFORMANCE ====
         chunk_batches = self.data.get_elements( 0 ) / batch_size
-        validation_score = self._get_validation_score(batch_size, epoch, 0)
-        test_score = self._get_test_score(batch_size)
-        training_score = self._get_training_score(chunk_batches)
+        validation_score = timer.time('validation', self._get_validation_score, batch_size, epoch, 0)
+        test_score = timer.time('test', self._get_test_score, batch_size)
+        training_score = timer.time('training_loss', self._get_training_score, chunk_batches)
 
         #==== UPDATE GUI ====
         if visual_params.gui_enabled:
-                interface.server.append_job_update(epoch, training_score, validation_score, test_score, learning_rate)
+                timer.time('gui', interface.server.append_job_update, epoch, training_score, validation_score,
+                           test_score, learning_rate)
 
         try:
             while (epoch < max_epochs) and (not done_looping):
@@ -183,26 +248,27 @@ class Evaluator(object):
 
                 if(epoch % 20 == 0):
                     print('---- Storing temp model')
-                    storage.store_params(self.model.params, id=str(epoch))
+                    timer.time('checkpoint', storage.store_params, self.model.params, id=str(epoch))
 
                 if(curriculum and epoch % curriculum_adjustment == 0 and epoch >= curriculum_start):
                     print("---- Mixing examples from next stage with training data")
-                    self.data.mix_in_next_stage()
+                    timer.time('curriculum', self.data.mix_in_next_stage)
 
                 #For current examples chunk in GPU memory
                 for chunk_index in range(nr_chunks):
-                    self.data.switch_active_training_set( chunk_index )
+                    timer.time('chunk_switch', self.data.switch_active_training_set, chunk_index)
                     nr_elements = self.data.get_elements( chunk_index )
                     chunk_batches = nr_elements / batch_size
 
                     #Each chunk contains a certain number of batches.
                     for minibatch_index in range(chunk_batches):
-                        cost_ij = self.train_model(minibatch_index, learning_rate, max_factor)
+                        cost_ij = timer.time('train', self.train_model, minibatch_index, learning_rate, max_factor)
+                        timer.examples += batch_size
                         if iter % 1000 == 0:
                             print('---- Training @ iter = {}. Patience = {}. Loss = {}'.format(iter, patience, cost_ij))
 
                         if visual_params.gui_enabled and iter % gui_frequency == 0:
-                            interface.server.get_command_status()
+                            timer.time('gui', interface.server.get_command_status)
 
                         if visual_params.gui_enabled and interface.server.is_testing():
                             self._debug(batch_size, chunk_batches, max_factor)
@@ -214,25 +280,31 @@ class Evaluator(object):
                         if (iter + 1) % validation_frequency == 0:
 
                             #==== CURRENT PERFORMANCE ====
-                            validation_score = self._get_validation_score(batch_size, epoch, minibatch_index)
-                            test_score = self._get_test_score(batch_size)
-                            train_score = self._get_training_score(chunk_batches) #No other purpose than charting
+                            validation_score = timer.time('validation', self._get_validation_score, batch_size,
+                                                          epoch, minibatch_index)
+                            test_score = timer.time('test', self._get_test_score, batch_size)
+                            #No other purpose than charting
+                            train_score = timer.time('training_loss', self._get_training_score, chunk_batches)
 
                             #==== UPDATE GUI ====
                             if visual_params.gui_enabled:
-                                    interface.server.append_job_update(
+                                    timer.time('gui', interface.server.append_job_update,
                                         epoch,
                                         train_score,
                                         validation_score,
                                         test_score,
                                         learning_rate)
-                            self.events.append({
-                                                "epoch": epoch,
-                                                "training_loss": train_score,
-                                                "validation_loss": validation_score,
-                                                "test_loss": test_score,
-                                                "training_rate": learning_rate
-                                            })
+                            event = {
+                                "epoch": epoch,
+                                "training_loss": train_score,
+                                "validation_loss": validation_score,
+                                "test_loss": test_score,
+                                "training_rate": learning_rate
+                            }
+                            #Time per phase since the previous event
+                            self._add_stall_time(timer)
+                            event.update(timer.collect('event'))
+                            self.events.append(event)
 
                             #==== EARLY STOPPING ====
                             if validation_score < best_validation_loss:
@@ -254,8 +326,19 @@ class Evaluator(object):
 
                         iter += 1 #Increment interation after each batch has been processed.
 
+                self._add_stall_time(timer)
+                epoch_timing = timer.collect('epoch')
+                epoch_timing['epoch'] = epoch
+                self.epochs.append(epoch_timing)
+                print('---- Epoch {} took {:.2f}s, {:.0f} examples/s. Waited {:.2f}s for chunk switches'.format(
+                    epoch, epoch_timing['duration'], epoch_timing['examples_per_second'],
+                    epoch_timing['time_chunk_stall']))
+                print('---- Training {:.2f}s, validation {:.2f}s, test {:.2f}s, training loss {:.2f}s'.format(
+                    epoch_timing['time_train'], epoch_timing['time_validation'], epoch_timing['time_test'],
+                    epoch_timing['time_training_loss']))
+
         except KeyboardInterrupt:
-            self.set_result(best_iter, iter, best_validation_loss, test_score, nr_learning_adjustments, epoch)
+            #The result is set below. Collecting the total timing twice would leave nothing for the second time.
             print("Inpterupted by user. Current model params will be saved now.")
         except Exception as e:
             print "Unexpected error:", sys.exc_info()[0]
@@ -263,6 +346,11 @@ class Evaluator(object):
         self.set_result(best_iter, iter, best_validation_loss, test_score, nr_learning_adjustments, epoch)
 
 
+    def _add_stall_time(self, timer):
+        timer.add('chunk_stall', self.data.reset_stall_time())
+        timer.add('evaluation_stall', self.data.reset_stall_time(evaluation=True))
+
+
     def set_result(self, best_iter, iter, valid, test, nr_learning_adjustments, epoch):
         end_time = timeit.default_timer()
         duration = (end_time - self.start_time) / 60.
@@ -274,11 +362,16 @@ class Evaluator(object):
               (valid_end_score, best_iter + 1, test_end_score))
         print('The code ran for %.2fm' % (duration))
 
+        #A run stopped in the middle of an epoch still counts the waiting of that epoch.
+        self._add_stall_time(self.timer)
+        timing = self.timer.collect('total')
         self.report['evaluation'] = {
             'best_iteration': best_iter+1, 'iteration': iter, 'test_score': test_end_score, 'valid_score': valid_end_score,
-            'learning_adjustments': nr_learning_adjustments, 'epoch': epoch, 'duration': duration
+            'learning_adjustments': nr_learning_adjustments, 'epoch': epoch, 'duration': duration,
+            'chunk_stall_time': timing['time_chunk_stall']
         }
         self.report['dataset'] = self.data.get_report()
+        self.report['timing'] = timing
 
 
     def get_result(self):
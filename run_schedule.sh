@@ -0,0 +1,3 @@
+#!/bin/sh
+
+python ./tools/schedule/run.py "$@"
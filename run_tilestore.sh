@@ -0,0 +1,3 @@
+#!/bin/sh
+
+python ./tools/convert/tilestore.py "$@"
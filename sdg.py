@@ -16,6 +16,12 @@ class Backpropagation:
         return getattr(sys.modules[__name__], backpropagation)(params)
 
 
+    @staticmethod
+    def get_state(optimizer):
+        #Shared variables an optimizer keeps between updates, in a fixed order.
+        return [v for name in sorted(vars(optimizer)) for v in getattr(optimizer, name)]
+
+
 class rmsprop(object):
     """
     RMSProp with nesterov momentum and gradient rescaling
@@ -0,0 +1,263 @@
+__author__ = 'olav'
+
+import os, json, hashlib, shutil
+import numpy as np
+
+from augmenter.aerial import Creator
+from augmenter.parallel import ParallelSampler
+
+batch_size = 10000 #Examples sampled or rebuilt before they are written to disk
+
+
+def get_key(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def store_batches(set_path, batches, nr_examples, records=False):
+    '''
+    Writes sampled batches to data.npy and labels.npy in set_path as they arrive, so only a single batch is kept in
+    memory. With records, the third element of each batch is written to records.npy.
+    '''
+    os.makedirs(set_path)
+    data = labels = stored_records = None
+    idx = 0
+    for data_batch, label_batch, extra in batches:
+        if data is None:
+            data = np.lib.format.open_memmap(os.path.join(set_path, 'data.npy'), mode='w+',
+                                             dtype=data_batch.dtype, shape=(nr_examples, data_batch.shape[1]))
+            labels = np.lib.format.open_memmap(os.path.join(set_path, 'labels.npy'), mode='w+',
+                                               dtype=label_batch.dtype, shape=(nr_examples, label_batch.shape[1]))
+            if records:
+                stored_records = np.lib.format.open_memmap(os.path.join(set_path, 'records.npy'), mode='w+',
+                                                           dtype=extra.dtype, shape=(nr_examples,))
+        data[idx: idx + data_batch.shape[0]] = data_batch
+        labels[idx: idx + label_batch.shape[0]] = label_batch
+        if records:
+            stored_records[idx: idx + extra.shape[0]] = extra
+        idx += data_batch.shape[0]
+    for array in [data, labels, stored_records]:
+        if array is not None:
+            array.flush()
+    del data, labels, stored_records
+
+
+def load_set(set_path):
+    return (np.load(os.path.join(set_path, 'data.npy'), mmap_mode='r'),
+            np.load(os.path.join(set_path, 'labels.npy'), mmap_mode='r'))
+
+
+def sample_evaluation_sets(creator, path, samples_per_image):
+    #Validation and test sets of creator, sampled without augmentation like in Creator.dynamically_create.
+    if creator.workers > 1:
+        sampler = ParallelSampler(creator, creator.workers, seed=creator.seed)
+        test, valid = sampler.sample([(creator.test, samples_per_image, {}), (creator.valid, samples_per_image, {})])
+        for set_name, (data, labels) in [('test', test), ('valid', valid)]:
+            store_batches(os.path.join(path, set_name), [(data, labels, None)], data.shape[0])
+        return
+    for set_name, dataset in [('test', creator.test), ('valid', creator.valid)]:
+        batches = creator.sample_batches(dataset, samples_per_image, batch_size)
+        store_batches(os.path.join(path, set_name), batches, creator.get_nr_examples(dataset, samples_per_image))
+
+
+def publish(tmp_path, path, manifest_name, params, set_names):
+    '''
+    Writes the manifest and renames the folder the sets were sampled into. An interrupted run does not leave a cached
+    set behind, and concurrent runs do not read a partial one.
+    '''
+    manifest = dict(params)
+    manifest['examples'] = {}
+    for set_name in set_names:
+        manifest['examples'][set_name] = int(load_set(os.path.join(tmp_path, set_name))[1].shape[0])
+    with open(os.path.join(tmp_path, manifest_name), 'w') as fp:
+        json.dump(manifest, fp, indent=1)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        #Another run stored the same sets first.
+        shutil.rmtree(tmp_path)
+
+
+def get_tmp_path(path):
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    return tmp_path
+
+
+class DatasetCache(object):
+    '''
+    Patch datasets sampled by a Creator, stored so later runs with the same sampling parameters can memory-map them
+    instead of sampling again. A dataset is addressed by a hash of the dataset path, the sampling parameters and the
+    seed. Label noise is kept as a separate layer on top of it. The training examples are sampled with clean labels,
+    together with their sampling plan records, and the noisy labels of each noise level and seed are extracted from
+    the records. Runs that only differ in label noise therefore share the sampled examples. This also means that with
+    only_mixed_labels, the road and non-road balance is drawn on the clean labels, while an uncached run with label
+    noise balances on the noisy labels. The examples of a cached noise run are therefore not the examples an uncached
+    run samples. Without evaluation, only the training set is cached, for runs that use FrozenEvaluationSets.
+    Layout: <path>/<key>/manifest.json, <path>/<key>/<set>/{data,labels}.npy, <path>/<key>/train/records.npy and
+    <path>/<key>/noise/<level>-<seed>.npy
+    '''
+    manifest_name = 'manifest.json'
+    version = 1
+
+    def __init__(self, path, creator, samples_per_image, evaluation=True):
+        if not creator.batched:
+            raise Exception('The dataset cache needs batched sampling')
+        self.creator = creator
+        self.samples_per_image = samples_per_image
+        self.evaluation = evaluation
+        self.params = {
+            'version': DatasetCache.version,
+            'dataset': os.path.abspath(creator.dataset_path),
+            'dim': [creator.dim_data, creator.dim_label],
+            'rotation': creator.rotation,
+            'preprocessing': creator.preprocessing,
+            'std': creator.std,
+            'only_mixed': creator.only_mixed_labels,
+            'mix_ratio': creator.mix_ratio,
+            'reduce': [creator.reduce_training, creator.reduce_validation, creator.reduce_testing],
+            'samples_per_image': samples_per_image,
+            'compact': creator.compact,
+            'seed': creator.seed,
+            'evaluation': evaluation
+        }
+        self.key = get_key(self.params)
+        self.path = os.path.join(path, self.key)
+
+
+    def get(self, enable_label_noise=False, label_noise=0.0):
+        '''
+        Memory-mapped train, valid and test sets. Missing layers are sampled and stored first.
+        :return: train, valid and test as data and labels. Valid and test are None without evaluation.
+        '''
+        self.creator.load_dataset()
+        if os.path.isfile(os.path.join(self.path, DatasetCache.manifest_name)):
+            print('---- Reusing cached dataset {}'.format(self.key))
+        else:
+            print('---- No cached dataset for these sampling parameters. Sampling {}'.format(self.key))
+            self._create()
+
+        train = load_set(os.path.join(self.path, 'train'))
+        if enable_label_noise and label_noise > 0:
+            train = train[0], self._load_noise(label_noise)
+        if not self.evaluation:
+            return train, None, None
+        return train, load_set(os.path.join(self.path, 'valid')), load_set(os.path.join(self.path, 'test'))
+
+
+    def _create(self):
+        creator = self.creator
+        tmp_path = get_tmp_path(self.path)
+        set_names = ['train']
+        if self.evaluation:
+            sample_evaluation_sets(creator, tmp_path, self.samples_per_image)
+            set_names += ['valid', 'test']
+
+        #Training examples are stored with their records, which the noise layers are extracted from.
+        train_path = os.path.join(tmp_path, 'train')
+        train_args = {'mixed_labels': creator.only_mixed_labels, 'rotation': creator.rotation, 'keep_records': True}
+        if creator.workers > 1:
+            sampler = ParallelSampler(creator, creator.workers, seed=creator.seed)
+            train, = sampler.sample([(creator.train, self.samples_per_image, train_args)])
+            store_batches(train_path, [train], train[0].shape[0], records=True)
+        else:
+            batches = creator.sample_batches(creator.train, self.samples_per_image, batch_size, **train_args)
+            store_batches(train_path, ((data, labels, records) for data, labels, stats, records in batches),
+                          creator.get_nr_examples(creator.train, self.samples_per_image), records=True)
+        publish(tmp_path, self.path, DatasetCache.manifest_name, self.params, set_names)
+
+
+    def _load_noise(self, label_noise):
+        '''
+        Noisy training labels of label_noise and the creator seed. Extracted from the training records if missing.
+        '''
+        seed = self.creator.seed
+        noise_path = os.path.join(self.path, 'noise', '{}-{}.npy'.format(label_noise, seed))
+        if not os.path.isfile(noise_path):
+            print('---- Adding label noise layer {} with seed {}'.format(label_noise, seed))
+            if not os.path.isdir(os.path.dirname(noise_path)):
+                os.makedirs(os.path.dirname(noise_path))
+            records = np.load(os.path.join(self.path, 'train', 'records.npy'), mmap_mode='r')
+            tmp_path = '{}.tmp-{}.npy'.format(noise_path[:-len('.npy')], os.getpid())
+            labels = None
+            for start in range(0, len(records), batch_size):
+                batch = np.array(records[start: start + batch_size])
+                batch['noise_seed'] = seed
+                label_batch = self.creator.extract_record_labels(self.creator.train, batch, self.creator.rotation,
+                                                                 label_noise=label_noise)
+                if labels is None:
+                    labels = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=label_batch.dtype,
+                                                       shape=(len(records), label_batch.shape[1]))
+                labels[start: start + len(batch)] = label_batch
+            if labels is not None:
+                labels.flush()
+                del labels
+                os.rename(tmp_path, noise_path)
+            else:
+                np.save(noise_path, np.load(os.path.join(self.path, 'train', 'labels.npy')))
+        return np.load(noise_path, mmap_mode='r')
+
+
+class FrozenEvaluationSets(object):
+    '''
+    Validation and test sets of a dataset, sampled once and stored. Early stopping during training and the precision
+    and recall measurement after training memory-map the same patches, and curves of different runs are measured on
+    identical patches. Examples are stored as compact uint8, and decoded with the preprocessing of the reader, so the
+    sets are addressed by a hash of only the dataset path, the patch dimensions and the sampling parameters.
+    Layout: <path>/evaluation-<key>/manifest.json and <path>/evaluation-<key>/{valid,test}/{data,labels}.npy
+    '''
+    manifest_name = 'manifest.json'
+    version = 1
+
+    def __init__(self, path, dataset_path, dim, samples_per_image, reduce_validation=1, reduce_testing=1, seed=0,
+                 workers=1, cache_size=0):
+        self.dataset_path = dataset_path
+        self.dim = dim
+        self.samples_per_image = samples_per_image
+        self.reduce_validation = reduce_validation
+        self.reduce_testing = reduce_testing
+        self.seed = seed
+        self.workers = workers
+        self.cache_size = cache_size
+        self.params = {
+            'version': FrozenEvaluationSets.version,
+            'dataset': os.path.abspath(dataset_path),
+            'dim': list(dim),
+            'reduce': [reduce_validation, reduce_testing],
+            'samples_per_image': samples_per_image,
+            'seed': seed
+        }
+        self.key = get_key(self.params)
+        self.path = os.path.join(path, 'evaluation-' + self.key)
+
+
+    @staticmethod
+    def create(path, dataset_path, dataset_config):
+        return FrozenEvaluationSets(path, dataset_path,
+                                    dim=(dataset_config.input_dim, dataset_config.output_dim),
+                                    samples_per_image=dataset_config.evaluation_samples_per_image,
+                                    reduce_validation=dataset_config.reduce_validation,
+                                    reduce_testing=dataset_config.reduce_testing,
+                                    seed=dataset_config.sampling_seed,
+                                    workers=dataset_config.sampling_workers,
+                                    cache_size=dataset_config.tile_cache_size)
+
+
+    def get(self, set_name):
+        '''
+        Memory-mapped examples of set_name, valid or test. Both sets are sampled and stored first if missing.
+        '''
+        if not os.path.isfile(os.path.join(self.path, FrozenEvaluationSets.manifest_name)):
+            self._create()
+        return load_set(os.path.join(self.path, set_name))
+
+
+    def _create(self):
+        print('---- Sampling frozen evaluation sets {}'.format(self.key))
+        creator = Creator(self.dataset_path, dim=self.dim, reduce_validation=self.reduce_validation,
+                          reduce_testing=self.reduce_testing, seed=self.seed, workers=self.workers,
+                          cache_size=self.cache_size, compact=True)
+        creator.load_dataset()
+        tmp_path = get_tmp_path(self.path)
+        sample_evaluation_sets(creator, tmp_path, self.samples_per_image)
+        publish(tmp_path, self.path, FrozenEvaluationSets.manifest_name, self.params, ['valid', 'test'])
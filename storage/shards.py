@@ -0,0 +1,247 @@
+__author__ = 'olav'
+
+import os, json
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+
+class ShardedSet(object):
+    '''
+    Patch dataset split in shards of a fixed number of examples. Each shard is a .npz file holding data and labels,
+    optionally compressed. A manifest holds the offset, count and road fraction of every shard, and the dtype and row
+    length of the examples, so a part of the set can be located and loaded without opening the other shards. Shards
+    are read in parallel.
+    Layout: <path>/manifest.json and <path>/shard-<nr>.npz
+    '''
+    manifest_name = 'manifest.json'
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, ShardedSet.manifest_name)) as fp:
+            self.manifest = json.load(fp)
+        self.shards = self.manifest['shards']
+
+
+    @staticmethod
+    def is_sharded(path):
+        return os.path.isfile(os.path.join(path, ShardedSet.manifest_name))
+
+
+    def __len__(self):
+        return self.manifest['count']
+
+
+    def load(self, shards=None, workers=4):
+        '''
+        Reads the examples of the given shard numbers, all shards by default, with a pool of threads. Decompression and
+        file reads release the GIL.
+        :return: data and labels
+        '''
+        return self.load_array('data', shards, workers), self.load_array('labels', shards, workers)
+
+
+    def load_array(self, name, shards=None, workers=4):
+        #Only the data or the labels of the shards, which are stored as separate members of the .npz files.
+        if shards is None:
+            shards = range(len(self.shards))
+        count = sum(self.shards[i]['count'] for i in shards)
+        array = np.empty((count, self.manifest[name]['length']), dtype=self.manifest[name]['dtype'])
+
+        offsets = np.cumsum([0] + [self.shards[i]['count'] for i in shards])
+        def read(job):
+            i, offset = job
+            with np.load(os.path.join(self.path, self.shards[i]['file'])) as shard:
+                array[offset: offset + self.shards[i]['count']] = shard[name]
+
+        pool = ThreadPool(max(1, min(workers, len(shards))))
+        try:
+            pool.map(read, zip(shards, offsets))
+        finally:
+            pool.close()
+            pool.join()
+        return array
+
+
+    def read(self, start, stop):
+        '''
+        Examples start to stop, only reading the shards they are stored in.
+        '''
+        rows = np.arange(start, stop)
+        return self.read_rows('data', rows), self.read_rows('labels', rows)
+
+
+    def read_rows(self, name, rows):
+        '''
+        The data or labels of the given rows, only reading the shards they are stored in.
+        '''
+        rows = np.asarray(rows, dtype=np.intp)
+        offsets = np.array([s['offset'] for s in self.shards], dtype=np.intp)
+        shard_of_row = np.searchsorted(offsets, rows, side='right') - 1
+        shards = np.unique(shard_of_row)
+        array = self.load_array(name, list(shards))
+        #Position of each shard in the loaded array.
+        starts = np.cumsum([0] + [self.shards[i]['count'] for i in shards])[:-1]
+        return array[starts[np.searchsorted(shards, shard_of_row)] + rows - offsets[shard_of_row]]
+
+
+    def get_shuffled_rows(self):
+        '''
+        All rows, with the shards in random order and the rows of every shard in random order. Consecutive rows of the
+        order are read from a few shards, so reading the order part by part decompresses every shard about once.
+        '''
+        order = np.random.permutation(len(self.shards))
+        rows = [self.shards[i]['offset'] + np.random.permutation(self.shards[i]['count']) for i in order]
+        return np.concatenate(rows) if rows else np.empty(0, dtype=np.intp)
+
+
+    def get_road_fraction(self):
+        if len(self) == 0:
+            return 0.0
+        return sum(s['road_fraction'] * s['count'] for s in self.shards) / float(len(self))
+
+
+class ShardedArray(object):
+    '''
+    Lazy view of the data or the labels of a ShardedSet, used in place of a memory-mapped array. Slices are views as
+    well, and shards are only read when rows are indexed or the view is converted with np.array. Only the shards
+    holding the rows are read. Rows assigned to a view are kept in memory on top of the shards, like the changed pages
+    of a copy-on-write memory map, and are shared by all views of the same array. They are stored as the sorted row
+    numbers and their values.
+    '''
+
+    def __init__(self, sharded_set, name, start=0, stop=None, changes=None):
+        self.sharded_set = sharded_set
+        self.name = name
+        self.start = start
+        self.stop = len(sharded_set) if stop is None else stop
+        self.dtype = np.dtype(sharded_set.manifest[name]['dtype'])
+        self.shape = (self.stop - self.start, sharded_set.manifest[name]['length'])
+        if changes is None:
+            changes = {'rows': np.empty(0, dtype=np.intp), 'values': np.empty((0, self.shape[1]), dtype=self.dtype)}
+        self.changes = changes #Assigned rows by row number in the set
+        self.ndim = 2
+        self.size = self.shape[0] * self.shape[1]
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, step = key.indices(len(self))
+            return ShardedArray(self.sharded_set, self.name, self.start + start, self.start + max(start, stop),
+                                self.changes)
+        rows = np.arange(self.start, self.stop)[key]
+        if np.ndim(rows) == 0:
+            return self._read(np.array([rows]))[0]
+        return self._read(rows)
+
+
+    def __setitem__(self, key, value):
+        rows = np.atleast_1d(np.arange(self.start, self.stop)[key])
+        value = np.asarray(value, dtype=self.dtype).reshape((len(rows), self.shape[1]))
+        #The last value assigned to a row is kept, like assigning to an array.
+        rows = np.concatenate([self.changes['rows'], rows])
+        values = np.concatenate([self.changes['values'], value])
+        last = len(rows) - 1 - np.unique(rows[::-1], return_index=True)[1]
+        self.changes['rows'] = rows[last]
+        self.changes['values'] = values[last]
+
+
+    def take(self, rows):
+        #Rows by their number in the set instead of in the view, so rows of several views are read together.
+        return self._read(np.asarray(rows, dtype=np.intp))
+
+
+    def __array__(self, dtype=None):
+        array = self._read(np.arange(self.start, self.stop))
+        return array if dtype is None else array.astype(dtype)
+
+
+    def _read(self, rows):
+        if len(rows) == 0:
+            return np.empty((0, self.shape[1]), dtype=self.dtype)
+        array = self.sharded_set.read_rows(self.name, rows)
+        changed_rows = self.changes['rows']
+        if len(changed_rows):
+            positions = np.minimum(np.searchsorted(changed_rows, rows), len(changed_rows) - 1)
+            changed = changed_rows[positions] == rows
+            array[changed] = self.changes['values'][positions[changed]]
+        return array
+
+
+class ShardWriter(object):
+    '''
+    Writes a ShardedSet. Examples are appended in batches of any size, and written as soon as a shard is full. The
+    manifest is written by close, so an interrupted write does not leave a readable set.
+    '''
+
+    def __init__(self, path, shard_size, compress=True):
+        self.path = path
+        self.shard_size = shard_size
+        self.compress = compress
+        self.shards = []
+        self.count = 0
+        self.pending = []
+        self.nr_pending = 0
+        self.formats = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+
+    def write(self, data, labels):
+        if self.formats is None:
+            self.formats = {
+                'data': {'dtype': data.dtype.str, 'length': data.shape[1]},
+                'labels': {'dtype': labels.dtype.str, 'length': labels.shape[1]}
+            }
+        self.pending.append((data, labels))
+        self.nr_pending += data.shape[0]
+        if self.nr_pending < self.shard_size:
+            return
+
+        data, labels = self._pop_pending()
+        start = 0
+        while data.shape[0] - start >= self.shard_size:
+            self._write_shard(data[start: start + self.shard_size], labels[start: start + self.shard_size])
+            start += self.shard_size
+        self.pending = [(data[start:], labels[start:])]
+        self.nr_pending = data.shape[0] - start
+
+
+    def close(self):
+        if self.nr_pending > 0:
+            self._write_shard(*self._pop_pending())
+        manifest = {
+            'version': ShardedSet.version,
+            'count': self.count,
+            'compressed': self.compress,
+            'shards': self.shards
+        }
+        manifest.update(self.formats or {'data': {'dtype': '|u1', 'length': 0}, 'labels': {'dtype': '|u1', 'length': 0}})
+        with open(os.path.join(self.path, ShardedSet.manifest_name), 'w') as fp:
+            json.dump(manifest, fp, indent=1)
+        return ShardedSet(self.path)
+
+
+    def _pop_pending(self):
+        data = np.concatenate([d for d, l in self.pending])
+        labels = np.concatenate([l for d, l in self.pending])
+        self.pending = []
+        self.nr_pending = 0
+        return data, labels
+
+
+    def _write_shard(self, data, labels):
+        name = 'shard-{:05d}.npz'.format(len(self.shards))
+        save = np.savez_compressed if self.compress else np.savez
+        save(os.path.join(self.path, name), data=data, labels=labels)
+        self.shards.append({
+            'file': name,
+            'offset': self.count,
+            'count': data.shape[0],
+            'road_fraction': float(np.mean(labels.max(axis=1) > 0))
+        })
+        self.count += data.shape[0]
@@ -45,12 +45,14 @@ class ParamStorage(object):
         pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
         f.close()
 
-    def store_result(self, path, loss, test_pr, valid_pr):
+    def store_result(self, path, loss, test_pr, valid_pr, epochs=None):
 
         data = [{
             'events': loss,
             'curve': test_pr,
             'valid_curve': valid_pr,
         }]
+        if epochs is not None:
+            data[0]['epochs'] = epochs
         with open(path, 'w') as fp:
             json.dump(data, fp)
\ No newline at end of file
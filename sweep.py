@@ -0,0 +1,107 @@
+import os
+
+from evaluator import Evaluator
+from model import ConvModel
+from data import DataLoader
+from util import Params
+import interface
+import printing
+from config import model_params, optimization_params, dataset_params, filename_params, visual_params, \
+    number_of_epochs, verbose, dataset_path
+from cnn import load_init_params, store_run, get_checkpoint_path
+
+'''
+Runs a sweep of config variants in a single process, instead of starting cnn.py once for every run. A variant is a
+loss function and a label noise, like the -config argument of cnn.py, and each variant is repeated a number of times.
+The dataset is loaded once and the functions of every loss are compiled once. Between runs, the weights and the
+optimizer state are reset with set_value, and the training set is reset, which undoes the curriculum stages mixed in
+by the previous run. If the loader keeps the label noise levels of a cached dataset, another noise
+level only replaces the training labels. Otherwise the dataset is loaded again, and the functions are bound to it from
+the function cache.
+Run i uses variant i modulo the number of variants, and is stored as batch<loss>-<noise>-<i>.pkl and .json in the
+results folder, the same as run_cnn_bootstrapping_batch.sh.
+Usage: python sweep.py -grid '[["bootstrapping", 0.2], ["crossentropy", 0.2]]' -repeats 6
+'''
+
+def get_runs(grid, repeats):
+    '''
+    Batch index, loss and label noise of every run. The runs are ordered by label noise and loss, so the dataset and
+    the compiled functions are switched as few times as possible.
+    '''
+    runs = []
+    for i in range(len(grid) * repeats):
+        loss, label_noise = grid[i % len(grid)]
+        runs.append((loss + "-" + str(float(label_noise)) + "-" + str(i), loss, float(label_noise)))
+    return sorted(runs, key=lambda run: (run[2], run[1]))
+
+
+def run_sweep(grid, repeats, model_params, optimization_params, dataset_path, dataset_params, filename_params,
+              visual_params, epochs, verbose=False, init=None):
+    if not os.path.exists(filename_params.results):
+        os.makedirs(filename_params.results)
+
+    dataset = None
+    label_noise = None
+    evaluators = {}
+    for batch_index, loss, run_noise in get_runs(grid, repeats):
+        printing.print_section('Sweep run {}'.format(batch_index))
+        #Stored with the params, like the -config argument of cnn.py sets it.
+        model_params.loss = loss
+        if run_noise != label_noise:
+            dataset_params.label_noise = run_noise
+            if dataset is None or not dataset.set_label_noise(dataset_params.use_label_noise, run_noise):
+                if dataset is not None:
+                    dataset.destroy()
+                dataset = DataLoader.create()
+                dataset.load(dataset_path, dataset_params, optimization_params.batch_size)
+                #The evaluators are bound to the shared variables of the previous dataset.
+                evaluators = {}
+            label_noise = run_noise
+        dataset.reset_training_set()
+
+        if loss in evaluators:
+            evaluator = evaluators[loss]
+            evaluator.reset()
+        else:
+            #The loss is part of the graph, so every loss has its own model and compiled functions.
+            config = Params(dict(vars(model_params), loss=loss))
+            evaluator = Evaluator(ConvModel(config, verbose=True), dataset, optimization_params, dataset_path)
+            evaluators[loss] = evaluator
+
+        evaluator.run(epochs=epochs, verbose=verbose, init=init,
+                      checkpoint_path=get_checkpoint_path(filename_params, batch_index))
+        store_run(evaluator, evaluator.model.model_config, dataset_params, optimization_params, filename_params,
+                  visual_params, batch_index)
+
+    if dataset is not None:
+        dataset.destroy()
+
+
+if __name__ == "__main__":
+    is_grid, grid = interface.command.get_command("-grid")
+    is_repeats, repeats = interface.command.get_command("-repeats", default="1")
+    is_curriculum, curriculum_set = interface.command.get_command("-curriculum")
+    is_init_params, param_path = interface.command.get_command("-params")
+    if not is_grid:
+        raise Exception('Supply a grid of variants, for instance -grid \'[["bootstrapping", 0.2]]\'')
+
+    if is_curriculum:
+        dataset_path = curriculum_set
+
+    weights = None
+    if is_init_params:
+        weights = load_init_params(param_path)
+
+    run_sweep(
+        grid                    = eval(grid),
+        repeats                 = int(repeats),
+        model_params            = model_params,
+        optimization_params     = optimization_params,
+        dataset_path            = dataset_path,
+        dataset_params          = dataset_params,
+        filename_params         = filename_params,
+        visual_params           = visual_params,
+        epochs                  = number_of_epochs,
+        verbose                 = verbose,
+        init                    = weights
+    )
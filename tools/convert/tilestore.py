@@ -0,0 +1,28 @@
+import sys, os
+
+sys.path.append(os.path.abspath("./"))
+
+from interface.command import get_command
+from printing import print_section
+from config import dataset_path
+from augmenter.store import TileStore
+
+'''
+This tool converts an aerial image dataset into a tile store. The dataset folder must contain train, valid and test
+sets, each with a data and labels folder. Every tile is decoded once and stored as an uint8 .npy file holding the RGB,
+alpha and label planes, and a manifest lists the tiles of each set. Point dataset_path in config to the store, and
+the Creator will memory-map the tiles instead of decoding images.
+-data: Path to dataset. Config used if not supplied
+-save: Path to where the tile store should be created.
+'''
+print_section("TOOLS: Creating tile store")
+
+is_alt_dataset, alt_dataset = get_command('-data')
+if is_alt_dataset:
+    dataset_path = alt_dataset
+
+is_save_path, save_path = get_command('-save')
+if not is_save_path:
+    raise Exception('Supply a path for the tile store with -save')
+
+TileStore.create(dataset_path, save_path)
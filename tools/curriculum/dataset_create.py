@@ -4,6 +4,8 @@ import sys, os
 sys.path.append(os.path.abspath("./"))
 
 from augmenter.aerial import Creator
+from augmenter.plan import SamplingPlan, record_dtype
+from storage.shards import ShardWriter
 import tools.util as util
 
 #TODO: Store in smaller files (Maybe)
@@ -11,13 +13,14 @@ import tools.util as util
 
 class CurriculumDataset(object):
 
-    def __init__(self, teacher, dataset_path, store_path, dataset_config, best_trade_off):
+    def __init__(self, teacher, dataset_path, store_path, dataset_config, best_trade_off, plan=False):
         self.dataset_path = dataset_path
         self.store_path = store_path
         self.teacher = teacher
         self.dataset_config = dataset_config
         self.rotate = dataset_config.use_rotation
         self.trade_off = best_trade_off
+        self.batch_size = 10000 #Examples sampled before they are written to disk
 
         if os.path.exists(self.store_path):
             raise Exception("Store path already exists")
@@ -27,7 +30,8 @@ class CurriculumDataset(object):
             os.makedirs(os.path.join(self.store_path, "valid"))
             os.makedirs(os.path.join(self.store_path, "test"))
 
-        self.evaluate = util.create_simple_predictor(teacher['model'], teacher['params'])
+        self.evaluate = util.create_batch_predictor(teacher['model'], teacher['params'],
+                                                    teacher['optimization'].batch_size)
         self.creator = Creator(
             self.dataset_path,
             dim=(self.dataset_config.input_dim, self.dataset_config.output_dim),
@@ -37,10 +41,17 @@ class CurriculumDataset(object):
             reduce_testing=self.dataset_config.reduce_testing,
             reduce_validation=self.dataset_config.reduce_validation,
             only_mixed=self.dataset_config.only_mixed_labels,
-            mix_ratio=self.dataset_config.mix_ratio
+            mix_ratio=self.dataset_config.mix_ratio,
+            compact=self.dataset_config.compact_storage
         )
         self.creator.load_dataset()
 
+        #A sampling plan only stores where the examples were sampled, and the examples are rebuilt when loaded.
+        self.plan = None
+        if plan:
+            rotation = ['train'] if self.rotate else []
+            self.plan = SamplingPlan.create(self.store_path, self.creator, rotation)
+
 
     def create_dataset(self, is_baseline, thresholds=None, base_sample=100, secondary_sample=100):
         print("---- Starting sampling. WARNING: this might take a while.")
@@ -65,12 +76,9 @@ class CurriculumDataset(object):
         '''
         Validation and test data is also pre-generated. This means the result is self contained.
         '''
-        data, labels = self.creator.sample_data(dataset, samples)
         stage_path = os.path.join(self.store_path, set_name)
-        os.makedirs(os.path.join(stage_path, "labels"))
-        os.makedirs(os.path.join(stage_path, "data"))
-        np.save(os.path.join(stage_path, "labels", "examples"), labels)
-        np.save(os.path.join(stage_path, "data", "examples"), data)
+        batches = self.creator.sample_batches(dataset, samples, self.batch_size, plan=self.plan is not None)
+        self._store_batches(stage_path, batches, self.creator.get_nr_examples(dataset, samples))
 
 
     def _generate_stage(self, name, threshold, samples):
@@ -83,16 +91,62 @@ class CurriculumDataset(object):
         print("SAMPLES ", samples)
         stage_path = os.path.join(self.store_path, "train", name)
         os.makedirs(stage_path)
-        data, labels = self.creator.sample_data(
+        batches = self.creator.sample_batches(
             self.creator.train,
             samples,
+            self.batch_size,
             mixed_labels=self.dataset_config.only_mixed_labels,
             curriculum=self.evaluate,
             curriculum_threshold=threshold,
             rotation=self.rotate,
-            best_trade_off=self.trade_off
+            best_trade_off=self.trade_off,
+            plan=self.plan is not None
         )
+        stage = int(name[len("stage"):])
+        self._store_batches(stage_path, batches, self.creator.get_nr_examples(self.creator.train, samples), stage)
+
+
+    def _store_batches(self, stage_path, batches, nr_examples, stage=0):
+        '''
+        Writes sampled batches to the examples.npy files as they arrive, so only a single batch is kept in memory.
+        For a sampling plan, only the records are written. With a shard size, the examples are written as a sharded
+        set instead.
+        '''
+        if self.plan:
+            if not os.path.isdir(stage_path):
+                os.makedirs(stage_path)
+            records = np.lib.format.open_memmap(os.path.join(stage_path, SamplingPlan.records_name), mode='w+',
+                                                dtype=record_dtype, shape=(nr_examples,))
+            idx = 0
+            for record_batch, label_batch, stats in batches:
+                records[idx: idx + record_batch.shape[0]] = record_batch
+                idx += record_batch.shape[0]
+            records['stage'] = stage
+            records.flush()
+            del records
+            return
+
+        if self.dataset_config.shard_size > 0:
+            writer = ShardWriter(stage_path, self.dataset_config.shard_size, self.dataset_config.shard_compression)
+            for data_batch, label_batch, stats in batches:
+                writer.write(data_batch, label_batch)
+            writer.close()
+            return
+
         os.makedirs(os.path.join(stage_path, "labels"))
         os.makedirs(os.path.join(stage_path, "data"))
-        np.save(os.path.join(stage_path, "labels", "examples"), labels)
-        np.save(os.path.join(stage_path, "data", "examples"), data)
+        data = labels = None
+        idx = 0
+        for data_batch, label_batch, stats in batches:
+            if data is None:
+                data = np.lib.format.open_memmap(os.path.join(stage_path, "data", "examples.npy"), mode='w+',
+                                                 dtype=data_batch.dtype, shape=(nr_examples, data_batch.shape[1]))
+                labels = np.lib.format.open_memmap(os.path.join(stage_path, "labels", "examples.npy"), mode='w+',
+                                                   dtype=label_batch.dtype, shape=(nr_examples, label_batch.shape[1]))
+            data[idx: idx + data_batch.shape[0]] = data_batch
+            labels[idx: idx + label_batch.shape[0]] = label_batch
+            idx += data_batch.shape[0]
+        if data is not None:
+            data.flush()
+            labels.flush()
+        del data, labels
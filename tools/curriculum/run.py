@@ -21,6 +21,7 @@ difficulty estimation. There are several properties that can be set, when using
 -currsamples: Samples per image for remaining stages
 -teacher: Curriculum teacher model
 -save: Path to where pre-generated patch dataset should be stored.
+-plan: Store a sampling plan instead of the examples. Load with the AerialPlanDataset loader.
 
 REMEMBER: The patch creator is initialized using the config.py file.
 '''
@@ -61,10 +62,13 @@ is_save_path, save_path = get_command('-save')
 if not is_save_path:
     save_path = filename_params.curriculum_location
 
+#Only store where examples are sampled, examples are rebuilt from the dataset tiles when loaded.
+is_plan, plan = get_command('-plan')
+
 #Load the curriculum teacher which provide consistency estimates for extracted examples.
 store = ParamStorage()
 teacher = store.load_params(path=teacher_location)
 
-generator = CurriculumDataset(teacher, dataset_path, save_path, dataset_params, tradeoff)
+generator = CurriculumDataset(teacher, dataset_path, save_path, dataset_params, tradeoff, plan=is_plan)
 generator.create_dataset(is_baseline, thresholds=stages, base_sample=init_stage_sample,
                          secondary_sample=curr_stage_sample)
\ No newline at end of file
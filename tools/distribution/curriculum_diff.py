@@ -1,5 +1,6 @@
 import numpy as np
 import sys, os
+import theano
 import matplotlib
 import matplotlib.pyplot as plt
 
@@ -10,6 +11,7 @@ from printing import print_section, print_action
 from storage import ParamStorage
 from config import filename_params, dataset_params, pr_path, dataset_path
 from augmenter.aerial import Creator
+from augmenter.util import decode_data, decode_labels
 from data import AerialCurriculumDataset
 import tools.util as util
 
@@ -42,7 +44,7 @@ if is_alt_dataset:
 
 store = ParamStorage()
 teacher = store.load_params(path=teacher_location)
-evaluate = util.create_simple_predictor(teacher['model'], teacher['params'])
+evaluate = util.create_batch_predictor(teacher['model'], teacher['params'], teacher['optimization'].batch_size)
 
 if not verify:
     creator = Creator(
@@ -64,6 +66,10 @@ if not verify:
 else:
     aerial_data = AerialCurriculumDataset()
     data, labels = aerial_data.load_set(dataset_path, "train", stage=stage)
+    if data.dtype == np.uint8:
+        #Compact examples are decoded the same way as when the teacher scored them while the set was created.
+        data = decode_data(data, dataset_params.dataset_std, dataset_params.use_preprocessing, theano.config.floatX)
+        labels = decode_labels(labels, theano.config.floatX)
 
 road_diff = []
 non_road_diff = []
@@ -74,16 +80,15 @@ nr_with_pred = 0
 
 best_trade_off = tradeoff
 nr_of_examples = data.shape[0]
+outputs = util.create_threshold_image(evaluate(data), best_trade_off)
 for i in range(nr_of_examples):
 
     if(i%1000 == 0):
         print("{}%".format(i/float(nr_of_examples) * 100))
 
-    data_sample = data[i]
     label_sample = labels[i]
-    output = evaluate(np.array([data_sample]))
-    output = util.create_threshold_image(output, best_trade_off)
-    diff = np.sum(np.abs(output[0] - label_sample))/(dataset_params.output_dim*dataset_params.output_dim)
+    output = outputs[i]
+    diff = np.sum(np.abs(output - label_sample))/(dataset_params.output_dim*dataset_params.output_dim)
 
     has_road = not (np.max(label_sample) == 0)
     pred_has_road = not (np.max(output) == 0)
@@ -1,13 +1,14 @@
 __author__ = 'olav'
 
 import numpy as np
+import theano
 import sys, os
 import scipy.ndimage as morph
 from PIL import Image
 sys.path.append(os.path.abspath("./"))
 
 from augmenter.aerial import Creator
-from data import AerialDataset
+from storage.dataset_cache import FrozenEvaluationSets
 import tools.util as util
 import augmenter.util as aug
 
@@ -28,22 +29,35 @@ class PrecisionRecallCurve(object):
     def get_curves_datapoints(self, batch_size, dataset=None, set_name="test"):
         if not dataset:
             print('---- Creating dataset')
-            dataset = self._create_dataset(set_name)
-
-        print('---- Generating output predictions using current model')
-        predictions, labels = self._predict_patches(dataset, batch_size)
+            batches, nr_examples = self._create_dataset(set_name, batch_size)
+            print('---- Generating output predictions using current model')
+            predictions, labels = self._predict_batches(batches, nr_examples, batch_size)
+        else:
+            print('---- Generating output predictions using current model')
+            predictions, labels = self._predict_patches(dataset, batch_size)
         print('---- Calculating precision and recall')
         datapoints = self._get_datapoints(predictions, labels)
         print('---- Got {} datapoints from tests'.format(len(datapoints)))
         return datapoints
 
 
-    def _create_dataset(self, set_name):
+    def _create_dataset(self, set_name, batch_size):
+        '''
+        Streams sampled examples from the set. Batches are predicted as they are sampled, so the sampled set is never
+        kept in memory as a whole.
+        :return: Generator of batches, and the total number of examples
+        '''
         dim = (self.dataset_config.input_dim, self.dataset_config.output_dim)
         path = self.dataset_path
         preprocessing = self.dataset_config.use_preprocessing
         print("---- Using preprossing: {}".format(preprocessing))
         std = self.dataset_config.dataset_std
+        if self.dataset_config.evaluation_sets:
+            #The same patches as the validation and test sets used during training.
+            frozen = FrozenEvaluationSets.create(self.dataset_config.evaluation_sets, path, self.dataset_config)
+            data, labels = frozen.get('valid' if set_name == 'valid' else 'test')
+            return self._decode_batches(data, labels, batch_size * 100), data.shape[0]
+
         samples_per_image = 200
         creator = Creator(path, dim=dim, preproccessing=preprocessing, std=std)
         creator.load_dataset()
@@ -53,8 +67,15 @@ class PrecisionRecallCurve(object):
             raw_set = creator.valid
         else:
             raw_set = creator.test
-        aerial = AerialDataset()
-        return aerial.shared_dataset(creator.sample_data(raw_set, samples_per_image), cast_to_int=True)
+        batches = creator.sample_batches(raw_set, samples_per_image, batch_size * 100)
+        return batches, creator.get_nr_examples(raw_set, samples_per_image)
+
+
+    def _decode_batches(self, data, labels, batch_size):
+        for start in range(0, data.shape[0], batch_size):
+            data_batch = aug.decode_data(data[start: start + batch_size], self.dataset_config.dataset_std,
+                                         self.dataset_config.use_preprocessing, theano.config.floatX)
+            yield data_batch, aug.decode_labels(labels[start: start + batch_size], theano.config.floatX), None
 
 
     def _predict_patches(self, dataset, batch_size):
@@ -68,6 +89,23 @@ class PrecisionRecallCurve(object):
         return result_output, result_label
 
 
+    def _predict_batches(self, batches, nr_examples, batch_size):
+        '''
+        Patch predictions for sampled batches, using the params.pkl or instantiated model.
+        '''
+        dim = self.dataset_config.output_dim
+        predict = util.create_batch_predictor(self.model_config, self.params, batch_size)
+        result_output = np.empty((nr_examples, dim*dim), dtype=theano.config.floatX)
+        result_label = np.empty((nr_examples, dim*dim), dtype=theano.config.floatX)
+
+        idx = 0
+        for data, label, stats in batches:
+            result_output[idx: idx + data.shape[0]] = predict(data)
+            result_label[idx: idx + data.shape[0]] = label
+            idx += data.shape[0]
+        return result_output, result_label
+
+
     def _get_datapoints(self, predictions, labels):
         '''
         Precision and recall found for different threshold values. For each value a binary output image is made.
@@ -0,0 +1,66 @@
+import sys, os
+import multiprocessing as mp
+
+#Makes sh scripts find modules.
+sys.path.append(os.path.abspath("./"))
+
+from printing import print_section
+from interface.command import get_command
+from config import dataset_params, filename_params, dataset_path, pr_path
+from data import DataLoader
+from storage.dataset_cache import FrozenEvaluationSets
+from scheduler import Scheduler, Job
+
+'''
+This tool runs a sweep of cnn.py experiments concurrently on a multi-core node, instead of one after another like
+run_cnn_bootstrapping_batch.sh. A variant is a loss function and a label noise, like the -config argument of cnn.py.
+Run i uses variant i modulo the number of variants, and stores its results as batch<loss>-<noise>-<i>.json in the
+results folder. Before the runs start, the dataset of every noise level and the frozen evaluation sets are sampled into
+the disk caches, so the runs read them instead of sampling the same examples at the same time.
+-grid: Variants, for instance '[["bootstrapping", 0.2], ["crossentropy", 0.2]]'
+-repeats: Number of runs of each variant
+-jobs: Number of concurrent runs. One per 4 cores, or per -threads cores, by default.
+-threads: OpenMP and BLAS threads, and sampling processes, of each run. The cores divided by the number of runs by
+          default.
+-retries: Number of times a failed run is started again.
+-curriculum: Pre-generated dataset used by the runs.
+-no_affinity: Do not bind the runs to cores.
+'''
+print_section("TOOLS: Scheduling concurrent experiments")
+
+is_grid, grid = get_command('-grid')
+if not is_grid:
+    raise Exception('Supply a grid of variants, for instance -grid \'[["bootstrapping", 0.2]]\'')
+grid = eval(grid)
+is_repeats, repeats = get_command('-repeats', default='1')
+is_jobs, jobs = get_command('-jobs')
+is_threads, threads = get_command('-threads')
+cores = mp.cpu_count()
+if not is_jobs:
+    jobs = cores // int(threads) if is_threads else cores // 4
+jobs = max(1, int(jobs))
+if not is_threads:
+    threads = cores // jobs
+threads = max(1, int(threads))
+is_retries, retries = get_command('-retries', default='1')
+is_curriculum, curriculum_set = get_command('-curriculum')
+no_affinity, value = get_command('-no_affinity')
+
+if is_curriculum:
+    dataset_path = curriculum_set
+
+print_section('Preparing dataset caches')
+for label_noise in sorted(set(float(noise) for loss, noise in grid)):
+    dataset_params.label_noise = label_noise
+    DataLoader.create().prepare(dataset_path, dataset_params)
+if dataset_params.evaluation_sets:
+    #Sets of the precision and recall measurement after training.
+    FrozenEvaluationSets.create(dataset_params.evaluation_sets, pr_path, dataset_params).get('test')
+
+runs = [Job(i, grid[i % len(grid)][0], grid[i % len(grid)][1], filename_params.results, curriculum_set)
+        for i in range(len(grid) * int(repeats))]
+scheduler = Scheduler(filename_params.results, jobs, threads, retries=int(retries),
+                      affinity=not no_affinity)
+failed = scheduler.run(runs)
+if failed:
+    sys.exit(1)
@@ -0,0 +1,157 @@
+import os, sys, time, json, subprocess
+import multiprocessing as mp
+from collections import deque
+from distutils.spawn import find_executable
+
+#Thread pools of the numerical libraries a run can use. Each is limited to the thread budget of the run.
+thread_variables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'GOTO_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def get_batch_index(loss, label_noise, nr):
+    #Same batch index as cnn.py creates from -batch and -config.
+    return loss + "-" + str(float(label_noise)) + "-" + str(nr)
+
+
+class Job(object):
+    '''
+    A single run of cnn.py. The run stores its results as batch<index>.json in the results folder.
+    '''
+
+    def __init__(self, nr, loss, label_noise, results, curriculum=None):
+        self.nr = nr
+        self.loss = loss
+        self.label_noise = float(label_noise)
+        self.batch_index = get_batch_index(loss, label_noise, nr)
+        self.result_path = os.path.join(results, "batch" + self.batch_index + ".json")
+        self.command = [sys.executable, "./cnn.py", "-batch", str(nr), "-config", json.dumps([loss, self.label_noise])]
+        if curriculum:
+            self.command += ["-curriculum", curriculum]
+        self.attempts = 0
+        self.process = None
+        self.log = None
+        self.start_time = None
+        self.durations = []
+        self.status = 'pending'
+
+
+    def is_done(self):
+        #Results of an earlier sweep with the same batch index do not count.
+        return os.path.isfile(self.result_path) and os.path.getmtime(self.result_path) >= self.start_time
+
+
+class Scheduler(object):
+    '''
+    Runs cnn.py experiments as concurrent processes on a multi-core node. Every run gets a slot, which is a thread
+    budget for OpenMP, the BLAS libraries and the processes sampling the dataset, and a set of cores the process is
+    bound to with taskset. A single Theano run on the CPU does not use every core well, so several runs with a few
+    cores each keep the node busy. Runs that fail, or exit without storing their results, are started again up to a
+    number of retries. The output of each attempt is written to <results>/logs/batch<index>-<attempt>.log.
+    '''
+
+    def __init__(self, results, slots, threads, retries=1, affinity=True, poll_interval=5):
+        self.results = results
+        self.slots = slots
+        self.threads = threads
+        self.retries = retries
+        self.poll_interval = poll_interval
+        self.taskset = find_executable('taskset') if affinity else None
+        self.cores = mp.cpu_count()
+        if affinity and not self.taskset:
+            print('---- taskset not found. Runs are not bound to cores')
+        if slots * threads > self.cores:
+            print('---- {} slots of {} threads oversubscribe {} cores'.format(slots, threads, self.cores))
+        self.log_path = os.path.join(results, "logs")
+        if not os.path.isdir(self.log_path):
+            os.makedirs(self.log_path)
+
+
+    def run(self, jobs):
+        '''
+        Runs the jobs, at most one per slot at a time, and returns when every job has finished or failed all its
+        attempts. A summary of the jobs is stored in <results>/schedule.json.
+        '''
+        pending = deque(jobs)
+        running = {}
+        free_slots = deque(range(self.slots))
+        start_time = time.time()
+        while pending or running:
+            while pending and free_slots:
+                slot = free_slots.popleft()
+                running[slot] = self._start(pending.popleft(), slot)
+
+            time.sleep(self.poll_interval)
+            for slot, job in running.items():
+                if job.process.poll() is None:
+                    continue
+                self._finish(job)
+                del running[slot]
+                free_slots.append(slot)
+                if job.status == 'failed' and job.attempts <= self.retries:
+                    print('---- Retrying {}, attempt {} of {}'.format(job.batch_index, job.attempts + 1,
+                                                                    self.retries + 1))
+                    pending.append(job)
+
+        failed = [job for job in jobs if job.status != 'done']
+        print('---- {} of {} runs done in {:.1f}m'.format(len(jobs) - len(failed), len(jobs),
+                                                        (time.time() - start_time) / 60.))
+        for job in failed:
+            print('---- {} failed {} times. See {}'.format(job.batch_index, job.attempts, self.log_path))
+        self._store_summary(jobs)
+        return failed
+
+
+    def get_cores(self, slot):
+        #Consecutive cores of the slot, wrapped around if the slots oversubscribe the node.
+        return [(slot * self.threads + i) % self.cores for i in range(self.threads)]
+
+
+    def get_environment(self):
+        env = dict(os.environ)
+        for name in thread_variables:
+            env[name] = str(self.threads)
+        return env
+
+
+    def _start(self, job, slot):
+        job.attempts += 1
+        job.status = 'running'
+        #The sampling processes default to one per core of the node, not of the slot.
+        command = job.command + ["-sampling_workers", str(self.threads)]
+        if self.taskset:
+            command = [self.taskset, '-c', ','.join(str(c) for c in self.get_cores(slot))] + command
+        log_name = os.path.join(self.log_path, "batch{}-{}.log".format(job.batch_index, job.attempts))
+        job.log = open(log_name, 'w')
+        job.start_time = time.time()
+        job.process = subprocess.Popen(command, stdout=job.log, stderr=subprocess.STDOUT,
+                                       env=self.get_environment())
+        print('---- Started {} in slot {}, attempt {}'.format(job.batch_index, slot, job.attempts))
+        return job
+
+
+    def _finish(self, job):
+        job.log.close()
+        job.durations.append(time.time() - job.start_time)
+        if job.process.returncode == 0 and job.is_done():
+            job.status = 'done'
+            print('---- Finished {} in {:.1f}m'.format(job.batch_index, job.durations[-1] / 60.))
+        else:
+            job.status = 'failed'
+            if job.process.returncode == 0:
+                print('---- {} exited without storing {}'.format(job.batch_index, job.result_path))
+            else:
+                print('---- {} exited with code {}'.format(job.batch_index, job.process.returncode))
+
+
+    def _store_summary(self, jobs):
+        summary = [{
+            'batch': job.batch_index,
+            'loss': job.loss,
+            'label_noise': job.label_noise,
+            'status': job.status,
+            'attempts': job.attempts,
+            'durations': job.durations,
+            'result': job.result_path
+        } for job in jobs]
+        with open(os.path.join(self.results, "schedule.json"), 'w') as fp:
+            json.dump(summary, fp, indent=1)
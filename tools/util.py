@@ -6,7 +6,8 @@ import theano
 import numpy as np
 
 sys.path.append(os.path.abspath("./"))
-from wrapper import create_output_func
+from wrapper import create_output_func, FunctionCache
+from config import filename_params
 from model import ConvModel
 
 
@@ -31,15 +32,35 @@ def create_predictor(dataset, model_config, model_params, batch_size):
     return create_output_func(dataset, x, y, drop, [index], model.get_output_layer(), batch_size)
 
 
-def create_simple_predictor(model_config, model_params):
+def create_simple_predictor(model_config, model_params, batch_size=1):
     #TODO: Does this single predictor even work?
     data = T.matrix('data')
     x = T.matrix('x')
     drop = T.iscalar('drop')
-    batch_size = 1
     model = ConvModel(model_config, verbose=True)
     model.build(x, drop, batch_size, init_params=model_params)
-    return model.create_predict_function(x, drop, data)
+    cache = FunctionCache(filename_params.function_cache, 'predictor', model_config, None, batch_size)
+    return cache.get(model.params, lambda: {'predict': model.create_predict_function(x, drop, data)})['predict']
+
+
+def create_batch_predictor(model_config, model_params, batch_size):
+    '''
+    Predictor that accepts any number of examples. The model is built for batch_size, and the examples are run through
+    it batch_size at a time. The last batch is padded with zeros.
+    '''
+    predict = create_simple_predictor(model_config, model_params, batch_size=batch_size)
+    output_dim = model_config.output_label_dim[0] * model_config.output_label_dim[1]
+
+    def batch_predictor(data):
+        nr_examples = data.shape[0]
+        output = np.empty((nr_examples, output_dim), dtype=theano.config.floatX)
+        batch = np.zeros((batch_size, data.shape[1]), dtype=theano.config.floatX)
+        for i in range(0, nr_examples, batch_size):
+            n = min(batch_size, nr_examples - i)
+            batch[:n] = data[i: i + n]
+            output[i: i + n] = predict(batch)[:n]
+        return output
+    return batch_predictor
 
 
 def batch_predict(predictor, dataset, dim, batch_size):
@@ -10,6 +10,47 @@ class Params:
              setattr(self, k, v)
 
 
+class PhaseTimer(object):
+    '''
+    Accumulates wall clock time spent in each phase of the training loop, and the number of examples trained on.
+    collect returns the times since the previous collect of the same interval, so the same timer can report per event
+    and per epoch. Timing a phase costs two clock reads.
+    '''
+    def __init__(self, phases):
+        self.phases = phases
+        self.times = dict((phase, 0.0) for phase in phases)
+        self.examples = 0
+        self.marks = {}
+        self.start = time.time()
+
+
+    def add(self, phase, seconds):
+        self.times[phase] += seconds
+
+
+    def time(self, phase, func, *args, **kwargs):
+        #Calls func, and adds the time of the call to phase.
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.times[phase] += time.time() - start
+        return result
+
+
+    def collect(self, interval):
+        '''
+        Seconds per phase since the last collect of interval, as time_<phase>, with the total duration and the
+        examples trained on per second.
+        '''
+        now = time.time()
+        times, examples, start = self.marks.get(interval, ({}, 0, self.start))
+        duration = now - start
+        result = dict(('time_' + phase, self.times[phase] - times.get(phase, 0.0)) for phase in self.phases)
+        result['duration'] = duration
+        result['examples_per_second'] = (self.examples - examples) / duration if duration > 0 else 0.0
+        self.marks[interval] = (dict(self.times), self.examples, now)
+        return result
+
+
 
 
 
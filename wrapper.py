@@ -1,5 +1,6 @@
 import theano
 import numpy as np
+import os, json, hashlib, pickle
 from util import Params
 
 '''
@@ -47,3 +48,100 @@ def create_output_func(dataset, x, y, drop, input, output_layer, batch_size):
     data = Params({'set': {'output': dataset}})
     output = (output_layer.output, y)
     return create_theano_func(name, data, x,y, drop, input, output, batch_size)
+
+
+class FunctionCache(object):
+    '''
+    Compiled theano functions stored on disk, so runs with the same graph do not compile it again. Functions are stored
+    under a hash of the model config, the optimization config if there is one, the batch size, and the source files that
+    build the graph, so an edit to a layer or loss function compiles the functions again. The shared
+    variables of a run, like the weights and the dataset chunks, are given as a list in a fixed order. They are stored
+    empty, and the stored functions are bound to the shared variables of the current run with Function.copy.
+    '''
+    version = 1
+    #Files that build the graphs, relative to the root of the repository. Directories include their python files.
+    graph_sources = ['model.py', 'sdg.py', 'wrapper.py', 'evaluator.py', 'elements', os.path.join('tools', 'util.py')]
+    source_hash = None
+
+    def __init__(self, path, name, model_config, optimization_config, batch_size):
+        self.path = None
+        if path:
+            config = {
+                'version': FunctionCache.version,
+                'theano': theano.__version__,
+                'floatX': theano.config.floatX,
+                'device': getattr(theano.config, 'device', 'cpu'),
+                'model': vars(model_config),
+                'batch_size': batch_size,
+                'source': FunctionCache.get_source_hash()
+            }
+            if optimization_config:
+                config['backpropagation'] = optimization_config.backpropagation
+                config['l2_reg'] = optimization_config.l2_reg
+                config['momentum'] = optimization_config.momentum
+            key = hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+            self.path = os.path.join(path, '{}-{}.pkl'.format(name, key))
+
+
+    @staticmethod
+    def get_source_hash():
+        if FunctionCache.source_hash is None:
+            root = os.path.dirname(os.path.abspath(__file__))
+            source = hashlib.sha1()
+            for name in FunctionCache.graph_sources:
+                path = os.path.join(root, name)
+                files = [path]
+                if os.path.isdir(path):
+                    files = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.py')]
+                for file_path in files:
+                    source.update(os.path.relpath(file_path, root).encode('utf-8'))
+                    with open(file_path, 'rb') as fp:
+                        source.update(fp.read())
+            FunctionCache.source_hash = source.hexdigest()
+        return FunctionCache.source_hash
+
+
+    def get(self, shared, compile):
+        '''
+        Cached functions bound to shared, or the functions returned by compile, which are then stored.
+        :param shared: The shared variables used by the functions, except state that is only used by the functions
+        :param compile: Returns a dict of compiled functions
+        '''
+        if self.path and os.path.isfile(self.path):
+            try:
+                with open(self.path, 'rb') as fp:
+                    cached = pickle.load(fp)
+                swap = dict(zip(cached['shared'], shared))
+                functions = {}
+                for name, f in cached['functions'].items():
+                    #Function.copy only accepts shared variables the function uses.
+                    inputs = set(i.variable for i in f.maker.inputs)
+                    functions[name] = f.copy(swap=dict((k, v) for k, v in swap.items() if k in inputs))
+                print('---- Using compiled functions from {}'.format(self.path))
+                return functions
+            except Exception as e:
+                print('---- Compiled functions in {} could not be used: {}'.format(self.path, e))
+
+        functions = compile()
+        if self.path:
+            self._store(shared, functions)
+        return functions
+
+
+    def _store(self, shared, functions):
+        #The values of the shared variables are not stored, only their types.
+        values = [v.get_value(borrow=True, return_internal_type=True) for v in shared]
+        try:
+            for v in shared:
+                v.set_value(np.zeros((0,) * v.ndim, dtype=v.dtype), borrow=True)
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            tmp_path = '{}.tmp-{}'.format(self.path, os.getpid())
+            with open(tmp_path, 'wb') as fp:
+                pickle.dump({'functions': functions, 'shared': shared}, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+        except Exception as e:
+            print('---- Compiled functions could not be stored: {}'.format(e))
+        finally:
+            for v, value in zip(shared, values):
+                v.set_value(value, borrow=True)